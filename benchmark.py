@@ -0,0 +1,316 @@
+import argparse
+import json
+import os
+import platform
+import subprocess
+import time
+import tracemalloc
+
+try:
+	import resource
+except ImportError:
+	resource = None
+
+import numpy as np
+import graflib as gl
+from examen3 import LightData, CameraData, FigureData, buildScene, figureGrid
+
+
+SHADING_MODELS = {"Flat": gl.SM_FLAT, "Gouraud": gl.SM_GOURAUD, "Phong": gl.SM_PHONG}
+RASTERIZERS = {"scanline": gl.RM_SCANLINE, "spans": gl.RM_SPANS, "deferred": gl.RM_DEFERRED, "edges": gl.RM_EDGES}
+
+
+# Renders a frame and returns its pixels and the time RenderScene() took.
+def RenderFrame(camera, instances, lights, size, stats = None):
+	canvas = gl.FrameBuffer(size, size)
+	depth_buffer = np.zeros(canvas.width * canvas.height)
+
+	start = time.perf_counter()
+	gl.RenderScene(canvas, depth_buffer, camera, instances, lights, stats=stats)
+	return canvas.pixels, time.perf_counter() - start
+
+
+# Best time of a few frames, after one warm-up frame (which also starts the worker processes).
+def TimeFrames(camera, instances, lights, size, frames):
+	pixels, _ = RenderFrame(camera, instances, lights, size)
+	best = min(RenderFrame(camera, instances, lights, size)[1] for i in range(0, frames))
+	return pixels, best
+
+
+# Speedup of tiled rendering against the single process span rasterizer, for a growing number of workers.
+def BenchmarkTiles(args):
+	gl.RasterizerMode = gl.RM_SPANS
+	gl.ShadingModel = SHADING_MODELS[args.shading]
+	gl.TileSize = args.tile_size
+	camera, instances, lights = buildScene(LightData(2, 3, 0, 90), CameraData(), FigureData(args.figure, 0, 0, 5, args.scale, 30))
+
+	gl.TileWorkers = 0
+	reference, base = TimeFrames(camera, instances, lights, args.size, args.frames)
+	print("cores: %d, figure: %s, shading: %s, tile size: %d" % (os.cpu_count(), args.figure, args.shading, args.tile_size))
+	print("%8s %10s %8s %s" % ("workers", "seconds", "speedup", "identical"))
+	print("%8s %10.4f %8.2f %s" % ("single", base, 1.0, True))
+
+	workers = 1
+	while (workers <= args.max_workers):
+		gl.TileWorkers = workers
+		pixels, seconds = TimeFrames(camera, instances, lights, args.size, args.frames)
+		print("%8d %10.4f %8.2f %s" % (workers, seconds, base / seconds, np.array_equal(pixels, reference)))
+		workers *= 2
+
+
+# ======================================================================
+#    Pipeline benchmark suite.
+# ======================================================================
+
+# Standard scenes: (name, figures, sphere divs). Spheres use the given divs instead of the UI's.
+SUITE_SCENES = [
+	("cube", [FigureData("Cube", 0, 0, 5, 1, 30)], None),
+	("sphere-10", [FigureData("Sphere", 0, 0, 5, 2, 10)], 10),
+	("sphere-25", [FigureData("Sphere", 0, 0, 5, 2, 10)], 25),
+	("sphere-50", [FigureData("Sphere", 0, 0, 5, 2, 10)], 50),
+	("instances", [FigureData("Cube" if (i + j) % 2 else "Sphere", 2.2*i, 2.2*j, 9 + i, 1, 20*(i + j)) for i in range(-1, 2) for j in range(-1, 2)], 25),
+	("crowd", figureGrid(FigureData("Cube", 0, -1, 4, 0.2, 30), (40, 1, 50), 0.6) + figureGrid(FigureData("Sphere", 0, 1.5, 6, 0.25), (20, 1, 20), 1.2), 8),
+]
+
+# Pipeline stages, and the graflib functions timed as each one. Time is exclusive: the shading
+# done inside setup or rasterization is only counted as shading.
+STAGES = {
+	"clip": ["TransformAndClip", "TransformAndClipInstances"],
+	"projection": ["ProjectVertices", "TransformNormals", "ProjectVertex"],
+	"cull": ["CullTriangles"],
+	"setup": ["SetupTriangleSpans", "SetupTriangleEdges"],
+	"raster": ["RasterizeSpans", "RenderTriangle"],
+	"shading": ["ComputeSceneIllumination", "ComputeIlluminationArray", "LightModelVertices", "ShadeGBuffer"],
+}
+
+
+def BuildSuiteScene(figures, divs):
+	camera, instances, lights = buildScene(LightData(2, 3, 0, 90), CameraData(), figures)
+	for figure, instance in zip(figures, instances):
+		if (divs != None and figure.type == "Sphere"):
+			instance.model = gl.Meshes.Get("Sphere", divs, gl.GREEN)
+	return camera, instances, lights
+
+
+# Replaces the stage functions of graflib with timed wrappers while it's active.
+class StageTimer:
+	def __init__(self):
+		self.seconds = dict((stage, 0.0) for stage in STAGES)
+		self.calls = dict((stage, 0) for stage in STAGES)
+		self.stack = []
+		self.originals = {}
+
+	def wrap(self, stage, function):
+		def timed(*args, **kwargs):
+			self.stack.append(0.0)
+			start = time.perf_counter()
+			try:
+				return function(*args, **kwargs)
+			finally:
+				elapsed = time.perf_counter() - start
+				self.seconds[stage] += elapsed - self.stack.pop()
+				self.calls[stage] += 1
+				if (self.stack):
+					self.stack[-1] += elapsed
+		return timed
+
+	def __enter__(self):
+		for stage, names in STAGES.items():
+			for name in names:
+				self.originals[name] = getattr(gl, name)
+				setattr(gl, name, self.wrap(stage, self.originals[name]))
+		return self
+
+	def __exit__(self, *exc):
+		for name, function in self.originals.items():
+			setattr(gl, name, function)
+
+
+def BenchmarkCase(camera, instances, lights, size, frames):
+	pixels, seconds = TimeFrames(camera, instances, lights, size, frames)
+
+	stats = gl.FrameStats()
+	with StageTimer() as timer:
+		RenderFrame(camera, instances, lights, size, stats)
+
+	tracemalloc.start()
+	RenderFrame(camera, instances, lights, size)
+	peak = tracemalloc.get_traced_memory()[1]
+	tracemalloc.stop()
+
+	triangles = sum(len(instance.model.index_array) for instance in instances)
+	return {
+		"frame_seconds": seconds,
+		"stage_seconds": timer.seconds,
+		"triangles": triangles,
+		"rasterized_triangles": stats.counters["triangles_rasterized"],
+		"drawn_pixels": int((pixels != 255).any(axis=2).sum()),
+		"counters": stats.AsDict(),
+		"pixels_per_second": size*size / seconds,
+		"triangles_per_second": triangles / seconds,
+		"peak_memory_bytes": peak,
+	}
+
+
+# Memory held by a model, measured as the bytes allocated while building it, and the time that took.
+def MeasureModel(build):
+	tracemalloc.start()
+	start = time.perf_counter()
+	model = build()
+	seconds = time.perf_counter() - start
+	size = tracemalloc.get_traced_memory()[0]
+	tracemalloc.stop()
+	return model, size, seconds
+
+
+# Memory and build time of the sphere as a Model (Vertex and Triangle objects plus its arrays)
+# and as a PackedMesh, for several numbers of divisions.
+def BenchmarkMemory(args):
+	print("%6s %10s %12s %12s %8s %10s %10s" % ("divs", "triangles", "Model KB", "packed KB", "ratio", "Model s", "packed s"))
+	for divs in args.divs:
+		model, model_size, model_seconds = MeasureModel(lambda: gl.GenerateSphere(divs, gl.GREEN))
+		mesh, mesh_size, mesh_seconds = MeasureModel(lambda: gl.GenerateSpherePacked(divs, gl.GREEN))
+		print("%6d %10d %12.1f %12.1f %8.1f %10.4f %10.4f" % (divs, len(mesh.indexes), model_size / 1024, mesh_size / 1024, model_size / mesh_size, model_seconds, mesh_seconds))
+
+
+# Frame time of the scanline rasterizer with its pixel loop in Python and in the compiled kernel
+# (see gl.ScanlineKernel), and whether both draw the same frame. The frames timed come after a
+# warm-up one, so the kernel's compilation, or its loading from the disk cache, is reported apart.
+def BenchmarkBackends(args):
+	gl.RasterizerMode = gl.RM_SCANLINE
+	gl.TileWorkers = 0
+	if (gl.ScanlineKernel == None):
+		print("numba isn't installed: only the Python backend is timed")
+	else:
+		print("numba %s, kernel warm-up: %.3f s" % (gl.numba.__version__, gl.WarmUpKernels()))
+
+	print("%-10s %-8s %10s %10s %8s %s" % ("scene", "shading", "python", "numba", "speedup", "identical"))
+	for name, figures, divs in [scene for scene in SUITE_SCENES if scene[0] in args.scenes]:
+		camera, instances, lights = BuildSuiteScene(figures, divs)
+		for shading in args.shading:
+			gl.ShadingModel = SHADING_MODELS[shading]
+			gl.UseJIT = False
+			reference, python = TimeFrames(camera, instances, lights, args.size, args.frames)
+			if (gl.ScanlineKernel == None):
+				print("%-10s %-8s %10.4f %10s %8s %s" % (name, shading, python, "-", "-", "-"))
+				continue
+
+			gl.UseJIT = True
+			pixels, compiled = TimeFrames(camera, instances, lights, args.size, args.frames)
+			print("%-10s %-8s %10.4f %10.4f %8.2f %s" % (name, shading, python, compiled, python / compiled, np.array_equal(pixels, reference)))
+	gl.UseJIT = True
+
+
+def Revision():
+	try:
+		return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True, cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip()
+	except OSError:
+		return None
+
+
+def BenchmarkSuite(args):
+	gl.RasterizerMode = RASTERIZERS[args.rasterizer]
+	gl.TileWorkers = 0
+	gl.UseBVH = args.bvh
+	gl.EarlyZ = args.early_z
+	gl.UseHiZ = args.hiz
+	gl.HiZTileSize = args.hiz_tile_size
+	scenes = [scene for scene in SUITE_SCENES if not args.scenes or scene[0] in args.scenes]
+
+	results = []
+	print("%-10s %-8s %9s %9s %9s %9s %9s %9s %9s %12s %12s %9s" % ("scene", "shading", "frame", "clip", "project", "cull", "setup", "raster", "shading", "pixels/s", "triangles/s", "peak MB"))
+	for name, figures, divs in scenes:
+		camera, instances, lights = BuildSuiteScene(figures, divs)
+		for shading in args.shading:
+			gl.ShadingModel = SHADING_MODELS[shading]
+			result = BenchmarkCase(camera, instances, lights, args.size, args.frames)
+			result.update({"scene": name, "shading": shading})
+			results.append(result)
+
+			stages = result["stage_seconds"]
+			print("%-10s %-8s %9.4f %9.4f %9.4f %9.4f %9.4f %9.4f %9.4f %12.0f %12.0f %9.2f" % (name, shading, result["frame_seconds"],
+				stages["clip"], stages["projection"], stages["cull"], stages["setup"], stages["raster"], stages["shading"],
+				result["pixels_per_second"], result["triangles_per_second"], result["peak_memory_bytes"] / 2**20))
+
+	report = {
+		"revision": Revision(),
+		"python": platform.python_version(),
+		"numpy": np.__version__,
+		"cores": os.cpu_count(),
+		"rasterizer": args.rasterizer,
+		"bvh": args.bvh,
+		"early_z": args.early_z,
+		"hiz_tile_size": args.hiz_tile_size if args.hiz else None,
+		"size": args.size,
+		"frames": args.frames,
+		"max_rss_kb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss if resource is not None else None,
+		"results": results,
+	}
+	if args.output:
+		with open(args.output, "w") as output:
+			json.dump(report, output, indent=2)
+		print("Saved %s" % args.output)
+
+
+# Frame time of each case of a suite run against a baseline run.
+def CompareSuites(args):
+	with open(args.baseline) as baseline, open(args.current) as current:
+		baseline, current = json.load(baseline), json.load(current)
+
+	before = dict(((r["scene"], r["shading"]), r["frame_seconds"]) for r in baseline["results"])
+	print("%s -> %s" % (baseline["revision"], current["revision"]))
+	print("%-10s %-8s %10s %10s %8s" % ("scene", "shading", "before", "after", "ratio"))
+	for r in current["results"]:
+		key = (r["scene"], r["shading"])
+		if key in before:
+			ratio = r["frame_seconds"] / before[key]
+			flag = "  slower" if ratio > 1 + args.tolerance else ""
+			print("%-10s %-8s %10.4f %10.4f %8.2f%s" % (key[0], key[1], before[key], r["frame_seconds"], ratio, flag))
+
+
+if __name__ == "__main__":
+	parser = argparse.ArgumentParser(description="Rasterizer benchmarks.")
+	commands = parser.add_subparsers(dest="command", required=True)
+
+	tiles = commands.add_parser("tiles", help="tiled rendering speedup against the number of worker processes")
+	tiles.add_argument("--figure", choices=["Cube", "Sphere"], default="Sphere")
+	tiles.add_argument("--shading", choices=list(SHADING_MODELS), default="Phong")
+	tiles.add_argument("--scale", type=float, default=3)
+	tiles.add_argument("--size", type=int, default=601)
+	tiles.add_argument("--tile-size", type=int, default=gl.TileSize)
+	tiles.add_argument("--max-workers", type=int, default=os.cpu_count())
+	tiles.add_argument("--frames", type=int, default=3)
+	tiles.set_defaults(run=BenchmarkTiles)
+
+	suite = commands.add_parser("suite", help="per-stage timings of the standard scenes, optionally saved as JSON")
+	suite.add_argument("--scenes", nargs="*", choices=[scene[0] for scene in SUITE_SCENES])
+	suite.add_argument("--shading", nargs="*", choices=list(SHADING_MODELS), default=list(SHADING_MODELS))
+	suite.add_argument("--size", type=int, default=601)
+	suite.add_argument("--frames", type=int, default=3)
+	suite.add_argument("--rasterizer", choices=list(RASTERIZERS), default="spans", help="scanline is the scalar RenderTriangle() loop")
+	suite.add_argument("--bvh", action="store_true", help="cull and sort the instances with an InstanceBVH")
+	suite.add_argument("--early-z", action="store_true", help="depth pass before shading (spans rasterizer only)")
+	suite.add_argument("--hiz", action="store_true", help="skip hidden triangles and tiles with a HiZBuffer")
+	suite.add_argument("--hiz-tile-size", type=int, choices=[8, 16], default=gl.HiZTileSize)
+	suite.add_argument("--output", help="JSON file for the results")
+	suite.set_defaults(run=BenchmarkSuite)
+
+	memory = commands.add_parser("memory", help="memory of the sphere as a Model and as a PackedMesh")
+	memory.add_argument("--divs", type=int, nargs="*", default=[10, 25, 50, 100, 200])
+	memory.set_defaults(run=BenchmarkMemory)
+
+	backends = commands.add_parser("backends", help="scanline rasterizer with the Python loop against the compiled kernel")
+	backends.add_argument("--scenes", nargs="*", choices=[scene[0] for scene in SUITE_SCENES], default=["cube", "sphere-25", "instances"])
+	backends.add_argument("--shading", nargs="*", choices=list(SHADING_MODELS), default=list(SHADING_MODELS))
+	backends.add_argument("--size", type=int, default=301)
+	backends.add_argument("--frames", type=int, default=3)
+	backends.set_defaults(run=BenchmarkBackends)
+
+	compare = commands.add_parser("compare", help="compares the frame times of two saved suite runs")
+	compare.add_argument("baseline")
+	compare.add_argument("current")
+	compare.add_argument("--tolerance", type=float, default=0.1, help="slowdown flagged as a regression")
+	compare.set_defaults(run=CompareSuites)
+
+	args = parser.parse_args()
+	args.run(args)
@@ -1,7 +1,10 @@
+import collections
 import math
+import queue
+import threading
+import time
 import tkinter as tk
 import graflib as gl
-import numpy as np
 from PIL import Image, ImageTk
 
 class LightData:
@@ -30,6 +33,204 @@ class FigureData:
 		self.rotation = figure_rotation		
 
 
+# Renders frames in a worker thread. Each request supersedes the previous one: the render in
+# progress is cancelled, and frames from stale requests are dropped when polled.
+class BackgroundRenderer:
+	def __init__(self):
+		self.generation = 0
+		self.cancel = None
+		self.results = queue.Queue()
+		self.incremental = IncrementalRenderer()
+		self.hierarchy = FigureHierarchy()
+		self.scaler = ResolutionScaler()
+		self.sizes = [CANVAS_SIZE]
+
+	def request(self, light_data, camera_data, figure_data, progressive = False, incremental = False, dynamic = False):
+		if self.cancel is not None:
+			self.cancel.set()
+		self.generation += 1
+		self.cancel = threading.Event()
+
+		# The progressive mode shows a low resolution preview before the full frame; the dynamic
+		# mode renders only at the size that fits the frame time target (see ResolutionScaler).
+		if dynamic:
+			self.sizes = [self.scaler.size()]
+		else:
+			self.sizes = [PREVIEW_SIZE, CANVAS_SIZE] if progressive else [CANVAS_SIZE]
+		worker = threading.Thread(target=self.run, args=(self.generation, self.cancel, light_data, camera_data, figure_data, self.sizes, incremental), daemon=True)
+		worker.start()
+
+	def run(self, generation, cancel, light_data, camera_data, figure_data, sizes, incremental):
+		for size in sizes:
+			stats = gl.FrameStats()
+			start = time.perf_counter()
+			if incremental and size == CANVAS_SIZE:
+				image = self.incremental.draw(light_data, camera_data, figure_data, size, cancel, stats)
+			else:
+				image = StartPage.drawCanvas(light_data, camera_data, figure_data, size, cancel, stats, hierarchy=self.hierarchy)
+				if image is not None:
+					self.scaler.record(size, time.perf_counter() - start)
+			if image is None:
+				return
+			self.results.put((generation, image, stats))
+
+	# Returns the newest frame rendered for the current request and its FrameStats, or (None, None).
+	def poll(self):
+		image, stats = None, None
+		while not self.results.empty():
+			generation, frame, frame_stats = self.results.get_nowait()
+			if generation == self.generation:
+				image, stats = frame, frame_stats
+		return image, stats
+
+
+CANVAS_SIZE = 601
+SPHERE_DIVS = 25
+# Sphere tessellations, as (divs, smallest projected radius in pixels): about 3 pixels per division.
+SPHERE_LEVELS = [(48, 144), (32, 96), (24, 72), (16, 48), (12, 36), (8, 0)]
+PREVIEW_SIZE = 151
+POLL_INTERVAL = 30  # ms
+SPHERE_LOD = None
+
+# Dynamic resolution: frame time target while the sliders move, the sizes the frames can take
+# (MIN_DYNAMIC_SIZE up to CANVAS_SIZE, in DYNAMIC_SIZE_STEP steps), the frames whose times
+# are kept, and how long input must be idle before the full resolution frame is rendered.
+DYNAMIC_FRAME_TIME = 0.1  # s
+MIN_DYNAMIC_SIZE = 121
+DYNAMIC_SIZE_STEP = 60
+FRAME_TIME_SAMPLES = 8
+IDLE_DELAY = 250  # ms
+
+# Frame and depth buffers shared by the renders of drawCanvas().
+FRAME_BUFFERS = gl.BufferPool()
+
+
+# Picks the canvas size of the frames rendered while the input changes, so that they take about
+# target seconds. Render time grows with the number of pixels, so the size comes from the median
+# time per pixel of the last frames of any size. Sizes are rounded down to a multiple of step
+# plus one, which keeps a center pixel and the number of sizes the buffers are kept for small.
+class ResolutionScaler:
+	def __init__(self, target = DYNAMIC_FRAME_TIME, min_size = MIN_DYNAMIC_SIZE, max_size = CANVAS_SIZE, step = DYNAMIC_SIZE_STEP, samples = FRAME_TIME_SAMPLES):
+		self.target = target
+		self.min_size = min_size
+		self.max_size = max_size
+		self.step = step
+		self.lock = threading.Lock()
+		self.times = collections.deque(maxlen=samples)
+
+	# Adds the time, in seconds, a size x size frame took.
+	def record(self, size, seconds):
+		with self.lock:
+			self.times.append(seconds / (size*size))
+
+	def size(self):
+		with self.lock:
+			if not self.times:
+				return self.max_size
+			per_pixel = sorted(self.times)[len(self.times)//2]
+
+		size = int(math.sqrt(self.target / per_pixel)) if per_pixel > 0 else self.max_size
+		size = (size - 1)//self.step*self.step + 1
+		return min(max(size, self.min_size), self.max_size)
+
+
+# Keeps the gl.InstanceBVH of the figures between frames while gl.UseBVH is set. When figures
+# moved since the last frame, only their spheres are refit in the tree; it's built again when
+# the number of figures changes. Frames of stale requests may cull with a newer tree, but
+# they are dropped anyway.
+class FigureHierarchy:
+	def __init__(self):
+		self.lock = threading.Lock()
+		self.bvh = None
+		self.figures = None
+
+	# Returns the tree for the instances built from figure_data, or None without gl.UseBVH.
+	def update(self, figure_data, instances):
+		if not gl.UseBVH:
+			self.bvh, self.figures = None, None
+			return None
+
+		figures = [dict(vars(figure)) for figure in (figure_data if isinstance(figure_data, list) else [figure_data])]
+		with self.lock:
+			if self.bvh is None or len(figures) != len(self.figures):
+				self.bvh = gl.InstanceBVH(instances)
+			else:
+				moved = [i for i in range(0, len(figures)) if figures[i] != self.figures[i]]
+				if moved:
+					self.bvh.Refit(instances, moved)
+			self.figures = figures
+			return self.bvh
+
+
+# Renders frames reusing the previous one (see gl.FrameCache). Each frame's data is compared
+# with the previous frame's: when only the lights changed, the visible pixels are shaded
+# again; when only figures moved, the union of their old and new screen rectangles is redrawn;
+# when nothing changed, the previous frame is returned. Anything else renders the full frame.
+# A figure whose level of detail changed counts as moved, since its tessellation changed.
+# Always uses the span rasterizer in the calling thread, whatever gl.RasterizerMode and
+# gl.TileWorkers are.
+class IncrementalRenderer:
+	def __init__(self):
+		self.lock = threading.Lock()
+		self.cache = None
+		self.key = None
+		self.lights = None
+		self.figures = None
+		self.models = None
+
+	# Same as StartPage.drawCanvas().
+	def draw(self, light_data, camera_data, figure_data, size = CANVAS_SIZE, cancel = None, stats = None):
+		# A render cancelled halfway leaves the cache incomplete, so the next one starts over.
+		with self.lock:
+			image = self.update(light_data, camera_data, figure_data, size, cancel, stats)
+			if image is None:
+				self.cache = None
+			return image
+
+	def update(self, light_data, camera_data, figure_data, size, cancel, stats):
+		start = time.perf_counter()
+		lights = [dict(vars(light)) for light in (light_data if isinstance(light_data, list) else [light_data])]
+		figures = [dict(vars(figure)) for figure in (figure_data if isinstance(figure_data, list) else [figure_data])]
+		key = (size, gl.ShadingModel, gl.LightingModel, dict(vars(camera_data)), [figure["type"] for figure in figures])
+
+		camera, instances, scene_lights = buildScene(light_data, camera_data, figure_data)
+		scene = gl.PreparedScene(camera, scene_lights, instances)
+		scene.stats = stats
+		gl.SelectLevelsOfDetail(size, instances, scene.transforms)
+		models = [instance.model for instance in instances]
+
+		moved = []
+		if self.cache is not None and key == self.key:
+			moved = [i for i in range(0, len(figures)) if figures[i] != self.figures[i] or models[i] is not self.models[i]]
+
+		if self.cache is None or key != self.key or (lights != self.lights and moved):
+			mode = "full"
+			self.cache = gl.FrameCache(size, size, (255, 255, 255))
+			gl.SetupCachedGeometry(self.cache, scene, instances)
+			done = gl.RasterizeCachedWindow(self.cache, scene, self.cache.canvas.window, cancel)
+		elif lights != self.lights:
+			mode = "lighting"
+			done = gl.ReshadeCachedFrame(self.cache, scene, cancel)
+		elif moved:
+			mode = "transform"
+			old_bounds = gl.UnionBounds([self.cache.bounds[i] for i in moved])
+			gl.SetupCachedGeometry(self.cache, scene, instances)
+			window = gl.UnionBounds([old_bounds] + [self.cache.bounds[i] for i in moved])
+			done = window is None or gl.RasterizeCachedWindow(self.cache, scene, window, cancel)
+		else:
+			mode = "unchanged"
+			done = True
+
+		if not done:
+			return None
+		self.key, self.lights, self.figures, self.models = key, lights, figures, models
+		if stats is not None:
+			stats.frames += 1
+			stats.AddTime("frame", start)
+		print("Rendered (%s)" % mode)
+		return Image.fromarray(self.cache.canvas.pixels)
+
+
 class rootApp(tk.Tk):
 	def __init__(self):
 		tk.Tk.__init__(self)
@@ -54,71 +255,98 @@ class StartPage(tk.Frame):
 		figureControllers = tk.LabelFrame(rightSide, text="Figura")
 		cameraControllers = tk.LabelFrame(rightSide, text="Camara")
 
-		light = LightData()
-		camera = CameraData()
-		figure = FigureData()
-		canva = self.drawCanvas(light, camera, figure)
-		tkpic = ImageTk.PhotoImage(canva)
-		label = tk.Label(leftSide, image=tkpic)
-		label.image = tkpic  # Save reference to image
-		label.pack(padx=10, pady=10)
+		# The frame is rendered in the background; the label shows a blank canvas until it's ready.
+		self.renderer = BackgroundRenderer()
+		tkpic = ImageTk.PhotoImage(Image.new("RGB", (CANVAS_SIZE, CANVAS_SIZE), (255, 255, 255)))
+		self.label = tk.Label(leftSide, image=tkpic)
+		self.label.image = tkpic  # Save reference to image
+		self.label.pack(padx=10, pady=10)
+
+		# Frame statistics, drawn over the top left corner of the frame when enabled.
+		self.stats_label = tk.Label(leftSide, justify=tk.LEFT, anchor=tk.NW, font=("Courier", 8), bg="white")
+		self.renderer.request(LightData(), CameraData(), FigureData())
+		self.after(POLL_INTERVAL, self.pollRender)
+		self.idle_job = None
 
 		@staticmethod
-		def callback():
+		def callback(*args):
 			light, camera, figure = self.buildRenderData()
-			canva = self.drawCanvas(light, camera, figure)
-			tkpic = ImageTk.PhotoImage(canva)
-			label.config(image=tkpic)
-			label.image = tkpic  # Save reference to image
+			self.renderer.request(light, camera, figure, self.progressive.get(), self.incremental.get(), self.dynamic.get())
+			if self.dynamic.get():
+				self.scheduleIdleRender()
 
 		# Light Controllers
-		self.x_light_bar = tk.Scale(lightControllers, label="X" ,from_=5, to=-5)
+		self.x_light_bar = tk.Scale(lightControllers, label="X" ,from_=5, to=-5, command=callback)
 		self.x_light_bar.pack(side=tk.LEFT)
-		self.y_light_bar = tk.Scale(lightControllers, label="Y" ,from_=5, to=-5)
+		self.y_light_bar = tk.Scale(lightControllers, label="Y" ,from_=5, to=-5, command=callback)
 		self.y_light_bar.pack(side=tk.LEFT)
-		self.z_light_bar = tk.Scale(lightControllers, label="Z" ,from_=5, to=-5)
+		self.z_light_bar = tk.Scale(lightControllers, label="Z" ,from_=5, to=-5, command=callback)
 		self.z_light_bar.pack(side=tk.LEFT)
-		self.intensity_light_bar = tk.Scale(lightControllers, label="Intensidad" ,from_=0, to=100)
+		self.intensity_light_bar = tk.Scale(lightControllers, label="Intensidad" ,from_=0, to=100, command=callback)
 		self.intensity_light_bar.pack(side=tk.LEFT)
 
 		# Figure UI controls
-		self.x_figure_bar = tk.Scale(figureControllers, label="X" ,from_=5, to=-5)
+		self.x_figure_bar = tk.Scale(figureControllers, label="X" ,from_=5, to=-5, command=callback)
 		self.x_figure_bar.pack(side=tk.LEFT)
-		self.y_figure_bar = tk.Scale(figureControllers, label="Y" ,from_=5, to=-5)
+		self.y_figure_bar = tk.Scale(figureControllers, label="Y" ,from_=5, to=-5, command=callback)
 		self.y_figure_bar.pack(side=tk.LEFT)
-		self.z_figure_bar = tk.Scale(figureControllers, label="Z" ,from_=15, to=5)
+		self.z_figure_bar = tk.Scale(figureControllers, label="Z" ,from_=15, to=5, command=callback)
 		self.z_figure_bar.pack(side=tk.LEFT)
-		self.scale_figure_bar = tk.Scale(figureControllers, label="Scale" ,from_=1, to=5)
+		self.scale_figure_bar = tk.Scale(figureControllers, label="Scale" ,from_=1, to=5, command=callback)
 		self.scale_figure_bar.pack(side=tk.LEFT)
-		self.rotation_figure_bar = tk.Scale(figureControllers, label="Rotation" ,from_=-180, to=180)
+		self.rotation_figure_bar = tk.Scale(figureControllers, label="Rotation" ,from_=-180, to=180, command=callback)
 		self.rotation_figure_bar.pack(side=tk.LEFT)
+		self.copies_figure_bar = tk.Scale(figureControllers, label="Copias" ,from_=1, to=40, command=callback)
+		self.copies_figure_bar.pack(side=tk.LEFT)
 
 		lighting_list = ["Flat", "Gouraud", "Phong"]
 		self.actual_lighting = tk.StringVar()
 		self.actual_lighting.set("Flat")
 		self.lighting_menu = tk.OptionMenu(figureControllers, self.actual_lighting, *lighting_list) 
 		self.lighting_menu.pack() 
+		self.actual_lighting.trace_add("write", callback)
 
 		figures_list = ["Cube", "Sphere"]
 		self.actual_figure = tk.StringVar()
 		self.actual_figure.set("Cube")
 		self.figure_menu = tk.OptionMenu(figureControllers, self.actual_figure, *figures_list) 
 		self.figure_menu.pack() 
+		self.actual_figure.trace_add("write", callback)
 
 		# Camera UI controls
-		self.x_camera_bar = tk.Scale(cameraControllers, label="X" ,from_=5, to=-5)
+		self.x_camera_bar = tk.Scale(cameraControllers, label="X" ,from_=5, to=-5, command=callback)
 		self.x_camera_bar.pack(side=tk.LEFT)
-		self.y_camera_bar = tk.Scale(cameraControllers, label="Y" ,from_=5, to=-5)
+		self.y_camera_bar = tk.Scale(cameraControllers, label="Y" ,from_=5, to=-5, command=callback)
 		self.y_camera_bar.pack(side=tk.LEFT)
-		self.z_camera_bar = tk.Scale(cameraControllers, label="Z" ,from_=-5, to=1)
+		self.z_camera_bar = tk.Scale(cameraControllers, label="Z" ,from_=-5, to=1, command=callback)
 		self.z_camera_bar.pack(side=tk.LEFT)
-		self.rotation_camera_bar = tk.Scale(cameraControllers, label="Rotation" ,from_=-180, to=180)
+		self.rotation_camera_bar = tk.Scale(cameraControllers, label="Rotation" ,from_=-180, to=180, command=callback)
 		self.rotation_camera_bar.pack(side=tk.LEFT)
 		
 		lightControllers.pack(padx=10)
 		figureControllers.pack(padx=10)
 		cameraControllers.pack(padx=10)
 
+		self.progressive = tk.BooleanVar(value=False)
+		progressive_check = tk.Checkbutton(rightSide, text="Progresivo", variable=self.progressive)
+		progressive_check.pack(padx=5)
+
+		self.incremental = tk.BooleanVar(value=False)
+		incremental_check = tk.Checkbutton(rightSide, text="Incremental", variable=self.incremental)
+		incremental_check.pack(padx=5)
+
+		self.dynamic = tk.BooleanVar(value=False)
+		dynamic_check = tk.Checkbutton(rightSide, text="Resolucion dinamica", variable=self.dynamic)
+		dynamic_check.pack(padx=5)
+
+		self.use_bvh = tk.BooleanVar(value=False)
+		bvh_check = tk.Checkbutton(rightSide, text="Jerarquia (BVH)", variable=self.use_bvh)
+		bvh_check.pack(padx=5)
+
+		self.show_stats = tk.BooleanVar(value=False)
+		stats_check = tk.Checkbutton(rightSide, text="Estadisticas", variable=self.show_stats, command=self.toggleStats)
+		stats_check.pack(padx=5)
+
 		render_button = tk.Button(rightSide, text="render", command=callback)
 		render_button.pack(padx=5)
 
@@ -126,12 +354,47 @@ class StartPage(tk.Frame):
 		rightSide.pack(side=tk.RIGHT)
 
 
+	# Shows the newest finished frame, if any, and keeps polling.
+	def pollRender(self):
+		image, stats = self.renderer.poll()
+		if image is not None:
+			width, height = image.size
+			if image.size != (CANVAS_SIZE, CANVAS_SIZE):
+				image = image.resize((CANVAS_SIZE, CANVAS_SIZE), Image.BILINEAR)
+			# The label keeps showing the same photo image; only its pixels change.
+			self.label.image.paste(image)
+			self.stats_label.config(text="canvas: %dx%d\n%s" % (width, height, stats.Report()))
+		self.after(POLL_INTERVAL, self.pollRender)
+
+
+	# In the dynamic resolution mode, renders the full resolution frame once the input has been
+	# idle for IDLE_DELAY ms. Every change pushes it back.
+	def scheduleIdleRender(self):
+		if self.idle_job is not None:
+			self.after_cancel(self.idle_job)
+		self.idle_job = self.after(IDLE_DELAY, self.renderIdle)
+
+
+	def renderIdle(self):
+		self.idle_job = None
+		if self.renderer.sizes[-1] != CANVAS_SIZE:
+			light, camera, figure = self.buildRenderData()
+			self.renderer.request(light, camera, figure, False, self.incremental.get())
+
+
+	def toggleStats(self):
+		if self.show_stats.get():
+			self.stats_label.place(in_=self.label, x=4, y=4)
+		else:
+			self.stats_label.place_forget()
+
+
 	@staticmethod
 	def setLighthing(light_type):
 		if light_type == "Flat":
 			gl.ShadingModel = 0
 		elif light_type == "Gouraud":
-			gl.ShadingModel = 2
+			gl.ShadingModel = 1
 		elif light_type == "Phong":
 			gl.ShadingModel = 2
 
@@ -139,54 +402,99 @@ class StartPage(tk.Frame):
 	# Take values from sliders and set them as atributes of controller objects
 	def buildRenderData(self):
 		self.setLighthing(self.actual_lighting.get())
+		gl.UseBVH = self.use_bvh.get()
 		light = LightData(self.x_light_bar.get(), self.y_light_bar.get(), self.z_light_bar.get(), self.intensity_light_bar.get())
 		camera = CameraData(self.x_camera_bar.get(), self.y_camera_bar.get(), self.z_camera_bar.get(), self.rotation_camera_bar.get())
 		figure = FigureData(self.actual_figure.get(), self.x_figure_bar.get(), self.y_figure_bar.get(), self.z_figure_bar.get(), self.scale_figure_bar.get(), self.rotation_figure_bar.get())
 
+		# With copies, the figure is repeated on a copies x copies grid in X and Z.
+		copies = self.copies_figure_bar.get()
+		if copies > 1:
+			figure = figureGrid(figure, (copies, 1, copies), 2.5*figure.scale)
+
 		return light, camera, figure
 
 
+	# Renders a size x size frame showing a viewport viewport units wide (None for gl.viewport_size).
+	# Returns None if cancel is set before it's finished.
+	# The counters and stage times of the frame are added to stats, if it's a gl.FrameStats.
+	# hierarchy is an optional FigureHierarchy that keeps the instance BVH from frame to frame.
 	@staticmethod
-	def drawCanvas(light_data, camera_data, figure_data):
-		canvas = Image.new("RGB", (601, 601), (255, 255, 255))
-		depth_buffer = np.zeros( canvas.size[0] * canvas.size[1])
-
-		vertices = gl.vertices
-		triangles = gl.triangles
-
-		if figure_data.type == "Cube":
-			cube = gl.Model(vertices, triangles, gl.Vertex(0, 0, 0), math.sqrt(3))
-			instance = gl.Instance(cube, gl.Vertex(figure_data.x, figure_data.y, figure_data.z), gl.MakeOYRotationMatrix(figure_data.rotation), figure_data.scale)
-		else:
-			sphere = gl.GenerateSphere(25, gl.GREEN)
-			instance = gl.Instance(sphere, gl.Vertex(figure_data.x, figure_data.y, figure_data.z), gl.MakeOYRotationMatrix(figure_data.rotation), figure_data.scale)
-
-		instances = [
-			instance
-		]
-		camera = gl.Camera(gl.Vertex(camera_data.x, camera_data.y, camera_data.z), gl.MakeOYRotationMatrix(camera_data.rotation))
-
-		s2 = math.sqrt(2)
-		camera.clipping_planes = [
-			gl.Plane(gl.Vertex(    0,     0,    1), -1), # Near
-			gl.Plane(gl.Vertex( s2,     0, s2),    0), # Left
-			gl.Plane(gl.Vertex(-s2,     0, s2),    0), # Right
-			gl.Plane(gl.Vertex(    0, -s2, s2),    0), # Top
-			gl.Plane(gl.Vertex(    0,    s2, s2),    0), # Bottom
-		]
-
-		lights = [
-			gl.Light(gl.LT_AMBIENT, 0.2),
-			gl.Light(gl.LT_DIRECTIONAL, 0.2, gl.Vertex(-1, 0, 1)),
-			gl.Light(gl.LT_POINT, light_data.intensity/100, gl.Vertex(light_data.x, light_data.y, light_data.z))
-		]
-
-		gl.RenderScene(canvas, depth_buffer, camera, instances, lights)
-		print("Rendered")
-		return canvas
+	def drawCanvas(light_data, camera_data, figure_data, size = CANVAS_SIZE, cancel = None, stats = None, viewport = None, hierarchy = None):
+		canvas, depth_buffer = FRAME_BUFFERS.Acquire(size, size, (255, 255, 255), viewport)
+		try:
+			camera, instances, lights = buildScene(light_data, camera_data, figure_data, viewport)
+			bvh = hierarchy.update(figure_data, instances) if hierarchy is not None else None
+			if not gl.RenderScene(canvas, depth_buffer, camera, instances, lights, cancel, stats, bvh):
+				return None
+			print("Rendered")
+			# PIL keeps RGB images padded to 4 bytes per pixel, so this is the one copy made per frame.
+			return Image.fromarray(canvas.pixels)
+		finally:
+			FRAME_BUFFERS.Release(canvas, depth_buffer)
+
+
+# Generates the meshes of every figure up front, so frames only look them up in the cache.
+def preloadMeshes():
+	global SPHERE_LOD
+	gl.Meshes.Get("Cube")
+	SPHERE_LOD = gl.MeshLOD("Sphere", SPHERE_LEVELS, gl.GREEN)
+	stats = gl.Meshes.Stats()
+	print("Meshes generated: %d in %.3f s" % (stats["misses"], stats["generation_time"]))
+
+
+# Copies of a figure on a grid of counts = (nx, ny, nz) figures, spacing apart. The grid is
+# centered on the figure in X and Y, and goes away from the camera from the figure in Z.
+def figureGrid(figure_data, counts, spacing):
+	nx, ny, nz = counts
+	return [FigureData(figure_data.type, figure_data.x + (i - (nx - 1)/2)*spacing, figure_data.y + (j - (ny - 1)/2)*spacing, figure_data.z + k*spacing, figure_data.scale, figure_data.rotation)
+		for k in range(0, nz) for j in range(0, ny) for i in range(0, nx)]
+
+
+# Builds the instance of a figure described by a FigureData. Spheres get their tessellation
+# from SPHERE_LOD when it's set; key tells the LOD which figure it is from frame to frame.
+def buildInstance(figure_data, key = None):
+	if figure_data.type == "Cube":
+		cube = gl.Meshes.Get("Cube")
+		return gl.Instance(cube, gl.Vertex(figure_data.x, figure_data.y, figure_data.z), gl.MakeOYRotationMatrix(figure_data.rotation), figure_data.scale)
+	else:
+		sphere = gl.Meshes.Get("Sphere", SPHERE_DIVS, gl.GREEN) if SPHERE_LOD is None else SPHERE_LOD.models[0]
+		return gl.Instance(sphere, gl.Vertex(figure_data.x, figure_data.y, figure_data.z), gl.MakeOYRotationMatrix(figure_data.rotation), figure_data.scale, SPHERE_LOD, key)
+
+
+# Builds the camera, instances and lights described by the controller objects. light_data and
+# figure_data may also be lists, for scenes with several point lights or figures. The clipping
+# planes fit a viewport viewport units wide (None for gl.viewport_size).
+def buildScene(light_data, camera_data, figure_data, viewport = None):
+	figures = figure_data if isinstance(figure_data, list) else [figure_data]
+	instances = [buildInstance(figures[i], i) for i in range(0, len(figures))]
+	camera = gl.Camera(gl.Vertex(camera_data.x, camera_data.y, camera_data.z), gl.MakeOYRotationMatrix(camera_data.rotation))
+
+	# The side planes go through the edges of the viewport (x/z and y/z = +-viewport/2 over the
+	# projection plane distance), so clipped triangles never reach outside the canvas.
+	viewport = gl.viewport_size if viewport is None else viewport
+	a = 2*gl.projection_plane_z/viewport
+	s = math.sqrt(a*a + 1)
+	camera.clipping_planes = [
+		gl.Plane(gl.Vertex(   0,    0,   1), -1), # Near
+		gl.Plane(gl.Vertex( a/s,    0, 1/s),  0), # Left
+		gl.Plane(gl.Vertex(-a/s,    0, 1/s),  0), # Right
+		gl.Plane(gl.Vertex(   0, -a/s, 1/s),  0), # Top
+		gl.Plane(gl.Vertex(   0,  a/s, 1/s),  0), # Bottom
+	]
+
+	lights = [
+		gl.Light(gl.LT_AMBIENT, 0.2),
+		gl.Light(gl.LT_DIRECTIONAL, 0.2, gl.Vertex(-1, 0, 1)),
+	]
+	for light in (light_data if isinstance(light_data, list) else [light_data]):
+		lights.append(gl.Light(gl.LT_POINT, light.intensity/100, gl.Vertex(light.x, light.y, light.z)))
+
+	return camera, instances, lights
 
 
 if __name__ == "__main__":
+	preloadMeshes()
 	app = rootApp()
 	app.title("Examen 3")
 	app.mainloop()      
\ No newline at end of file
@@ -1,34 +1,121 @@
+import collections
+import concurrent.futures
 import math
+import threading
+import time
 import numpy as np
 
+try:
+	import numba
+except ImportError:
+	numba = None
+
+
+# ======================================================================
+#    Frame buffer.
+# ======================================================================
+
+# An RGB frame buffer backed by a contiguous (height, width, 3) uint8 array.
+# Canvas coordinates have the origin at the center and Y pointing up. The canvas shows a viewport
+# viewport units wide on the projection plane; None takes the module's viewport_size.
+class FrameBuffer:
+	def __init__(self, width, height, background = (255, 255, 255), window = None, viewport = None):
+		self.width = width
+		self.height = height
+		self.viewport_size = viewport_size if (viewport == None) else viewport
+
+		# The part of the canvas held in pixels, as (left, top, right, bottom) screen coordinates.
+		# It is the whole canvas, except for frame buffers that hold a single tile.
+		self.window = (0, 0, width, height) if window is None else window
+		left, top, right, bottom = self.window
+		self.pixels = np.empty((bottom - top, right - left, 3), dtype=np.uint8)
+		self.pixels[:, :] = background
+
+	# Converts canvas coordinates to (column, row) in the buffer. Works on scalars and arrays.
+	def ToScreen(self, x, y):
+		return self.width//2 + x, self.height//2 - y
+
+
+# Keeps frame buffers and depth buffers between renders. Acquire() returns a frame buffer and
+# a depth buffer of the given size, cleared in place to the background color and to 1/z = 0, reusing
+# a pair given back with Release() when there's one; new buffers are only allocated for a size
+# with none free, or when several renders overlap. At most per_size pairs of each size are kept,
+# and the buffers of the sizes least recently used are dropped once more than sizes sizes are kept. Depth buffers are float32 by default, half the
+# memory traffic of float64; the rasterizers compute 1/z in float64 and store it rounded.
+class BufferPool:
+	def __init__(self, depth_dtype = np.float32, sizes = 4, per_size = 2):
+		self.depth_dtype = depth_dtype
+		self.sizes = sizes
+		self.per_size = per_size
+		self.free = collections.OrderedDict()
+		self.lock = threading.Lock()
+		self.allocations = 0
+		self.reuses = 0
+
+	def Acquire(self, width, height, background = (255, 255, 255), viewport = None):
+		with self.lock:
+			buffers = self.free.get((width, height))
+			if (buffers):
+				framebuffer, depth_buffer = buffers.pop()
+				self.reuses += 1
+			else:
+				framebuffer, depth_buffer = None, None
+				self.allocations += 1
+
+		if (framebuffer == None):
+			return FrameBuffer(width, height, background, viewport=viewport), np.zeros(width*height, dtype=self.depth_dtype)
+
+		framebuffer.viewport_size = viewport_size if (viewport == None) else viewport
+		framebuffer.pixels[:, :] = background
+		depth_buffer.fill(0)
+		return framebuffer, depth_buffer
+
+	def Release(self, framebuffer, depth_buffer):
+		key = (framebuffer.width, framebuffer.height)
+		with self.lock:
+			buffers = self.free.setdefault(key, [])
+			if (len(buffers) < self.per_size):
+				buffers.append((framebuffer, depth_buffer))
+			self.free.move_to_end(key)
+			while (len(self.free) > self.sizes):
+				self.free.popitem(last=False)
+
+
+# Returns a frame buffer for a canvas, copying a PIL image if that's what was given.
+def AsFrameBuffer(canvas):
+	if (isinstance(canvas, FrameBuffer)):
+		return canvas
+
+	framebuffer = FrameBuffer(canvas.width, canvas.height)
+	framebuffer.pixels[:, :] = np.asarray(canvas.convert("RGB"))
+	return framebuffer
+
 
 # The PutPixel() function.
 def PutPixel(canvas, x, y, color):
-	x = canvas.width/2 + x
-	y = canvas.height/2 - y
-
-	color = np.array(color).astype(int)
+	x, y = canvas.ToScreen(x, y)
+	left, top, right, bottom = canvas.window
 
-	if (x < 0 or x >= canvas.width or y < 0 or y >= canvas.height):
+	if (x < left or x >= right or y < top or y >= bottom):
 		return
-	canvas.putpixel((int(x), int(y)), tuple(color))
+	canvas.pixels[y - top, x - left] = (int(color[0]), int(color[1]), int(color[2]))
 
 
 # ======================================================================
 #    Depth buffer.
 # ======================================================================
 
+# The depth buffer is a flat array of 1/z values, one per pixel of the frame buffer, row by row.
 def UpdateDepthBufferIfCloser(canvas, depth_buffer, x, y, inv_z):
-	x = canvas.width/2 + (x | 0)
-	y = canvas.height/2 - (y | 0) - 1
+	x, y = canvas.ToScreen(x, y)
+	left, top, right, bottom = canvas.window
 
-	if (x < 0 or x >= canvas.width or y < 0 or y >= canvas.height):
+	if (x < left or x >= right or y < top or y >= bottom):
 		return False
-	
 
-	offset = x + canvas.width*y
-	if (depth_buffer[int(offset)] == None or depth_buffer[int(offset)] < inv_z):
-		depth_buffer[int(offset)] = inv_z
+	offset = (x - left) + (right - left)*(y - top)
+	if (depth_buffer[offset] == None or depth_buffer[offset] < inv_z):
+		depth_buffer[offset] = inv_z
 		return True
 	
 	return False
@@ -104,14 +191,91 @@ class Model:
 		self.bounds_center = bounds_center
 		self.bounds_radius = bounds_radius
 
+		# Packed copies for the batched pipeline: (N,4) homogeneous vertices, (T,3) vertex indexes,
+		# (T,3,3) normals at the corners of each triangle, and (T,3) colors.
+		self.vertex_array = VertexArray(vertices)
+		self.index_array = np.array([triangle.indexes for triangle in triangles], dtype=int).reshape(-1, 3)
+		self.normal_array = np.array([[[n.x, n.y, n.z] for n in triangle.normals] for triangle in triangles], dtype=float).reshape(-1, 3, 3)
+		self.color_array = np.array([triangle.color for triangle in triangles], dtype=int).reshape(-1, 3)
+
+
+# A model transformed into camera space and clipped, in the same array form as Model: the
+# clipped triangles reference the model vertices and the vertices added by the clipping.
+class ClippedModel:
+	def __init__(self, vertex_array, index_array, normal_array, color_array, bounds_center, bounds_radius):
+		self.vertex_array = vertex_array
+		self.index_array = index_array
+		self.normal_array = normal_array
+		self.color_array = color_array
+		self.bounds_center = bounds_center
+		self.bounds_radius = bounds_radius
+
+
+# A model stored only as compact arrays, with no Vertex or Triangle objects: float32 (N,3)
+# positions, float32 (T,3,3) corner normals, int32 (T,3) vertex indexes and uint8 (T,3) colors.
+# It has the array attributes of Model, built from those on each access, so it can be used as
+# the model of an Instance. PackModel() and UnpackMesh() convert to and from Model.
+class PackedMesh:
+	def __init__(self, positions, normals, indexes, colors, bounds_center, bounds_radius):
+		self.positions = np.asarray(positions, dtype=np.float32).reshape(-1, 3)
+		self.normals = np.asarray(normals, dtype=np.float32).reshape(-1, 3, 3)
+		self.indexes = np.asarray(indexes, dtype=np.int32).reshape(-1, 3)
+		self.colors = np.asarray(colors, dtype=np.uint8).reshape(-1, 3)
+		self.bounds_center = bounds_center
+		self.bounds_radius = bounds_radius
+
+	@property
+	def vertex_array(self):
+		return np.concatenate((self.positions, np.ones((len(self.positions), 1), dtype=np.float32)), axis=1)
+
+	@property
+	def index_array(self):
+		return self.indexes
+
+	@property
+	def normal_array(self):
+		return self.normals
+
+	@property
+	def color_array(self):
+		return self.colors
+
+	# Bytes held by the arrays.
+	def Size(self):
+		return self.positions.nbytes + self.normals.nbytes + self.indexes.nbytes + self.colors.nbytes
+
+
+def PackModel(model):
+	return PackedMesh(model.vertex_array[:, :3], model.normal_array, model.index_array, model.color_array, model.bounds_center, model.bounds_radius)
+
+
+# Builds a Model, with its Vertex and Triangle objects, from a PackedMesh.
+def UnpackMesh(mesh):
+	vertices = [Vertex(x, y, z) for x, y, z in mesh.positions.tolist()]
+	triangles = [Triangle(indexes, color, [Vertex(n[0], n[1], n[2]) for n in normals])
+		for indexes, color, normals in zip(mesh.indexes.tolist(), mesh.colors.tolist(), mesh.normals.tolist())]
+	return Model(vertices, triangles, mesh.bounds_center, mesh.bounds_radius)
+
+
+# Packs a list of vertices into an (N,4) array in homogeneous coordinates.
+def VertexArray(vertices):
+	if (isinstance(vertices, np.ndarray)):
+		return vertices
+
+	return np.array([[v.x, v.y, v.z, 1.0] for v in vertices], dtype=float).reshape(-1, 4)
+
 
 # An Instance.
+# With a MeshLOD, RenderScene() replaces the model by one of its levels every frame; lod_key
+# identifies the instance across frames, so the LOD can remember the level it had.
 class Instance: 
-	def __init__(self, model, position, orientation = Identity4x4, scale = 1.0):
+	def __init__(self, model, position, orientation = Identity4x4, scale = 1.0, lod = None, lod_key = None):
 		self.model = model
 		self.position = position
 		self.orientation = orientation
 		self.scale = scale
+		self.lod = lod
+		self.lod_key = lod_key
 
 		self.transform = MultiplyMM4(MakeTranslationMatrix(self.position), MultiplyMM4(self.orientation, MakeScalingMatrix(self.scale)))
 
@@ -222,6 +386,39 @@ def MultiplyMV(mat4x4, vec4):
 	return Vertex4(result[0], result[1], result[2], result[3])
 
 
+# Multiplies a 4x4 matrix and an (N,4) array of vertices, in one pass over the array.
+# The products are summed in the same order as MultiplyMV(), so the results match it exactly.
+def MultiplyMVArray(mat4x4, vertices):
+	m = mat4x4.data
+	x, y, z, w = vertices[:, 0], vertices[:, 1], vertices[:, 2], vertices[:, 3]
+
+	result = np.empty((len(vertices), 4))
+	for i in range(0, 4):
+		result[:, i] = m[i][0]*x + m[i][1]*y + m[i][2]*z + m[i][3]*w
+
+	return result
+
+
+# Multiplies a (K,4,4) array of matrices and an (N,4) array of vertices, giving the (K,N,4)
+# array of the vertices transformed by each matrix. Same sums as MultiplyMVArray().
+def MultiplyMVBatch(matrices, vertices):
+	m = matrices[:, :, :, None]
+	x, y, z, w = vertices[:, 0], vertices[:, 1], vertices[:, 2], vertices[:, 3]
+
+	result = np.empty((len(matrices), len(vertices), 4))
+	for i in range(0, 4):
+		result[:, :, i] = m[:, i, 0]*x + m[:, i, 1]*y + m[:, i, 2]*z + m[:, i, 3]*w
+
+	return result
+
+
+# Rotates a (T,3,3) array of corner normals by a normal matrix. Same results as MultiplyMV() on Vertex4(normal).
+def TransformNormals(normal_matrix, normals):
+	flat = normals.reshape(-1, 3)
+	homogeneous = np.concatenate((flat, np.ones((len(flat), 1))), axis=1)
+	return MultiplyMVArray(normal_matrix, homogeneous)[:, :3].reshape(normals.shape)
+
+
 # Multiplies two 4x4 matrices.
 def MultiplyMM4(matA, matB):
 	result = Mat4x4([[0, 0, 0, 0], [0, 0, 0, 0], [0, 0, 0, 0], [0, 0, 0, 0]])
@@ -234,6 +431,17 @@ def MultiplyMM4(matA, matB):
 	return result
 
 
+# Multiplies a 4x4 matrix by each matrix of a (K,4,4) array. Same sums as MultiplyMM4().
+def MultiplyMM4Batch(matA, matrices):
+	a = matA.data
+	result = np.empty((len(matrices), 4, 4))
+	for i in range(0, 4):
+		for j in range(0, 4):
+			result[:, i, j] = a[i][0]*matrices[:, 0, j] + a[i][1]*matrices[:, 1, j] + a[i][2]*matrices[:, 2, j] + a[i][3]*matrices[:, 3, j]
+
+	return result
+
+
 # Transposes a 4x4 matrix.
 def Transposed(mat):
 	result = Mat4x4([[0, 0, 0, 0], [0, 0, 0, 0], [0, 0, 0, 0], [0, 0, 0, 0]])
@@ -269,7 +477,7 @@ def MultiplyColor(color, k):
 #    Rasterization code.
 # ======================================================================
 
-# Scene setup.
+# Scene setup. viewport_size is the default of the frame buffers (see FrameBuffer).
 viewport_size = 1
 projection_plane_z = 1
 
@@ -321,14 +529,14 @@ def DrawWireframeTriangle(p0, p1, p2, color):
 
 # Converts 2D viewport coordinates to 2D canvas coordinates.
 def ViewportToCanvas(p2d, canvas):
-	return Pt(int(p2d.x * canvas.width / viewport_size) | 0, int(p2d.y * canvas.height / viewport_size) | 0, None)
+	return Pt(int(p2d.x * canvas.width / canvas.viewport_size) | 0, int(p2d.y * canvas.height / canvas.viewport_size) | 0, None)
 
 
 # Converts 2D canvas coordinates to 2D viewport coordinates.
 def CanvasToViewport(canvas, p2d):
 	return Pt(
-		(p2d.x * viewport_size / canvas.width),
-		(p2d.y * viewport_size / canvas.height),
+		(p2d.x * canvas.viewport_size / canvas.width),
+		(p2d.y * canvas.viewport_size / canvas.height),
 		None
 	)
 
@@ -337,6 +545,23 @@ def ProjectVertex(canvas, v):
 	return ViewportToCanvas(Pt(v.x * projection_plane_z / v.z, v.y * projection_plane_z / v.z, None), canvas)
 
 
+# Projects an (N,4) array of vertices and converts them to canvas coordinates. Returns an (N,2) int array.
+def ProjectVertices(canvas, vertices):
+	with np.errstate(divide="ignore", invalid="ignore"):
+		x = vertices[:, 0] * projection_plane_z / vertices[:, 2]
+		y = vertices[:, 1] * projection_plane_z / vertices[:, 2]
+		# Vertices behind the camera only belong to clipped triangles; their values are never used.
+		return np.stack((x * canvas.width / canvas.viewport_size, y * canvas.height / canvas.viewport_size), axis=1).astype(int)
+
+
+# Array version of UnProjectVertex(). Returns the (K,3) camera-space points.
+def UnProjectVertices(canvas, x, y, inv_z):
+	oz = 1.0 / inv_z
+	ux = x*oz / projection_plane_z
+	uy = y*oz / projection_plane_z
+	return np.stack((ux * canvas.viewport_size / canvas.width, uy * canvas.viewport_size / canvas.height, oz), axis=1)
+
+
 def UnProjectVertex(canvas, x, y, inv_z):
 	oz = 1.0 / inv_z
 	ux = x*oz / projection_plane_z
@@ -362,13 +587,150 @@ def SortedVertexIndexes(vertex_indexes, projected):
 	return indexes
 
 
+# Same as SortedVertexIndexes(), given the projected Y of the three vertices.
+def SortedIndexes(y0, y1, y2):
+	ys = [y0, y1, y2]
+	indexes = [0, 1, 2]
+
+	if (ys[indexes[1]] < ys[indexes[0]]):
+		indexes[0], indexes[1] = indexes[1], indexes[0]
+
+	if (ys[indexes[2]] < ys[indexes[0]]):
+		indexes[0], indexes[2] = indexes[2], indexes[0]
+
+	if (ys[indexes[2]] < ys[indexes[1]]):
+		indexes[1], indexes[2] = indexes[2], indexes[1]
+
+	return indexes
+
+
 def ComputeTriangleNormal(v0, v1, v2):
 	v0v1 = Add(v1, Multiply(-1, v0))
 	v0v2 = Add(v2, Multiply(-1, v0))
 	return Cross(v0v1, v0v2)
 
 
+# ======================================================================
+#    Instrumentation.
+# ======================================================================
+
+# Counters and stage times of a frame. RenderScene() fills one when it's given one, or when
+# StatsCallback is set; otherwise the counting sites only check that scene.stats is None.
+COUNTERS = [
+	"instances",             # instances submitted
+	"instances_culled",      # instances rejected by the bounding sphere test
+	"triangles",             # triangles of the instances that were not culled
+	"triangles_clipped",     # triangles split by a clipping plane, counted once per plane
+	"triangles_outside",     # triangles dropped for being entirely behind a clipping plane
+	"triangles_backface",    # triangles dropped by backface culling
+	"triangles_degenerate",  # front faces dropped for having no area on screen
+	"triangles_offscreen",   # front faces dropped for being outside the frame buffer window
+	"triangles_rasterized",  # triangles that reached the rasterizer
+	"pixels_tested",         # pixels depth tested
+	"pixels_written",        # pixels that passed the depth test
+	"pixels_shaded",         # pixels lit and colored, fewer than the written ones when overdraw isn't shaded
+	"triangles_hiz_rejected",  # triangles the hierarchical depth buffer hid entirely
+	"tiles_hiz_rejected",    # hidden depth tiles skipped inside the other triangles
+	"pixels_hiz_rejected",   # pixels of those tiles, not depth tested
+	"illumination_points",   # points lit by ComputeSceneIllumination() or ComputeIlluminationArray()
+]
+
+
+class FrameStats:
+	def __init__(self):
+		self.counters = dict.fromkeys(COUNTERS, 0)
+		self.seconds = collections.OrderedDict()
+		self.frames = 0
+
+	def Count(self, name, amount = 1):
+		self.counters[name] += amount
+
+	# Adds the time since start (a time.perf_counter() value) to a stage.
+	def AddTime(self, stage, start):
+		self.seconds[stage] = self.seconds.get(stage, 0.0) + time.perf_counter() - start
+
+	def Merge(self, other):
+		for name, value in other.counters.items():
+			self.counters[name] += value
+		for stage, seconds in other.seconds.items():
+			self.seconds[stage] = self.seconds.get(stage, 0.0) + seconds
+		self.frames += other.frames
+
+	def AsDict(self):
+		return {"frames": self.frames, "counters": dict(self.counters), "seconds": dict(self.seconds)}
+
+	# Fraction of the triangles that reached triangle setup that were culled there.
+	def CulledFraction(self):
+		c = self.counters
+		culled = c["triangles_backface"] + c["triangles_degenerate"] + c["triangles_offscreen"]
+		return culled / max(1, culled + c["triangles_rasterized"])
+
+	# Short multi-line summary, for overlays and logs.
+	def Report(self):
+		c = self.counters
+		lines = [
+			"instances %d, culled %d" % (c["instances"], c["instances_culled"]),
+			"triangles %d, clipped %d, outside %d" % (c["triangles"], c["triangles_clipped"], c["triangles_outside"]),
+			"backface %d, degenerate %d, offscreen %d, rasterized %d (%.1f%% culled)" % (c["triangles_backface"], c["triangles_degenerate"], c["triangles_offscreen"], c["triangles_rasterized"], 100*self.CulledFraction()),
+			"pixels tested %d, written %d, shaded %d" % (c["pixels_tested"], c["pixels_written"], c["pixels_shaded"]),
+			"hi-z rejected triangles %d, tiles %d, pixels %d" % (c["triangles_hiz_rejected"], c["tiles_hiz_rejected"], c["pixels_hiz_rejected"]),
+			"illumination points %d" % c["illumination_points"],
+			", ".join("%s %.1f ms" % (stage, 1000*seconds) for stage, seconds in self.seconds.items()),
+		]
+		return "\n".join(lines)
+
+
+# Called with the FrameStats of every frame RenderScene() finishes, when set.
+StatsCallback = None
+
+
+# Per-frame values shared by all the triangles: the camera matrix, the lights
+# transformed into camera space, and the model-view and normal matrices of each instance.
+# stats is the FrameStats of the frame, or None when it's not instrumented.
+# hiz is the HiZBuffer of the depth buffer, or None when it's not used.
+class PreparedScene:
+	def __init__(self, camera, lights, instances = []):
+		self.camera = camera
+		self.lights = lights
+		self.stats = None
+		self.hiz = None
+		self.camera_matrix = MultiplyMM4(Transposed(camera.orientation), MakeTranslationMatrix(Multiply(-1, camera.position)))
+		self.camera_lights = TransformLights(camera, lights, self.camera_matrix)
+
+		# Multiply the matrices of all the instances at once.
+		transforms = np.array([instance.transform.data for instance in instances], dtype=float).reshape(-1, 4, 4)
+		orientations = np.array([instance.orientation.data for instance in instances], dtype=float).reshape(-1, 4, 4)
+		self.transforms = [Mat4x4(m) for m in MultiplyMM4Batch(self.camera_matrix, transforms).tolist()]
+		self.normal_matrices = [Mat4x4(m) for m in MultiplyMM4Batch(Transposed(camera.orientation), orientations).tolist()]
+
+
+# Returns copies of the lights with their vectors in camera space.
+def TransformLights(camera, lights, camera_matrix):
+	camera_lights = []
+	for l in range(0, len(lights)):
+		light = lights[l]
+		if (light.type == LT_DIRECTIONAL):
+			vector = MultiplyMV(Transposed(camera.orientation), Vertex4(light.vector))
+		elif (light.type == LT_POINT):
+			vector = MultiplyMV(camera_matrix, Vertex4(light.vector))
+		else:
+			vector = light.vector
+		camera_lights.append(Light(light.type, light.intensity, vector))
+
+	return camera_lights
+
+
 def ComputeIllumination(vertex, normal, camera, lights):
+	return ComputeSceneIllumination(vertex, normal, PreparedScene(camera, lights))
+
+
+# Computes the illumination at a camera-space point, with the lights of a PreparedScene.
+def ComputeSceneIllumination(vertex, normal, scene):
+	camera = scene.camera
+	lights = scene.camera_lights
+	if (scene.stats != None):
+		scene.stats.Count("illumination_points")
+
 	illumination = 0
 	for l in range(0, len(lights)):
 		light = lights[l]
@@ -378,13 +740,9 @@ def ComputeIllumination(vertex, normal, camera, lights):
 		
 		# var vl
 		if (light.type == LT_DIRECTIONAL):
-			cameraMatrix = Transposed(camera.orientation)
-			rotated_light = MultiplyMV(cameraMatrix, Vertex4(light.vector))
-			vl = rotated_light
+			vl = light.vector
 		elif (light.type == LT_POINT):
-			cameraMatrix = MultiplyMM4(Transposed(camera.orientation), MakeTranslationMatrix(Multiply(-1, camera.position)))
-			transformed_light = MultiplyMV(cameraMatrix, Vertex4(light.vector))
-			vl = Add(transformed_light, Multiply(-1, vertex)) # light.vector - vertex
+			vl = Add(light.vector, Multiply(-1, vertex)) # light.vector - vertex
 		
 
 		# Diffuse component.
@@ -406,6 +764,50 @@ def ComputeIllumination(vertex, normal, camera, lights):
 	return illumination
 
 
+# Array version of ComputeSceneIllumination(). positions and normals are (K,3) arrays of
+# camera-space points and their normals; returns the (K,) array of intensities.
+def ComputeIlluminationArray(positions, normals, scene):
+	camera = scene.camera
+	lights = scene.camera_lights
+	if (scene.stats != None):
+		scene.stats.Count("illumination_points", len(positions))
+
+	view = np.array([camera.position.x, camera.position.y, camera.position.z]) - positions
+	normal_length = np.sqrt(DotArray(normals, normals))
+
+	illumination = np.zeros(len(positions))
+	with np.errstate(divide="ignore", invalid="ignore"):
+		for l in range(0, len(lights)):
+			light = lights[l]
+			if (light.type == LT_AMBIENT):
+				illumination += light.intensity
+				continue
+
+			vector = np.array([light.vector.x, light.vector.y, light.vector.z])
+			if (light.type == LT_DIRECTIONAL):
+				vl = np.broadcast_to(vector, positions.shape)
+			elif (light.type == LT_POINT):
+				vl = vector - positions
+
+			# Diffuse component.
+			if (LightingModel & LM_DIFFUSE):
+				cos_alpha = DotArray(vl, normals) / (np.sqrt(DotArray(vl, vl)) * normal_length)
+				illumination += np.where(cos_alpha > 0, cos_alpha * light.intensity, 0)
+
+			# Specular component.
+			if (LightingModel & LM_SPECULAR):
+				reflected = 2*DotArray(normals, vl)[:, None]*normals - vl
+				cos_beta = DotArray(reflected, view) / (np.sqrt(DotArray(reflected, reflected)) * np.sqrt(DotArray(view, view)))
+				specular = 50
+				illumination += np.where(cos_beta > 0, np.power(cos_beta, specular) * light.intensity, 0)
+
+	return illumination
+
+
+# Row by row dot product of two (K,3) arrays.
+def DotArray(v1, v2):
+	return v1[:, 0]*v2[:, 0] + v1[:, 1]*v2[:, 1] + v1[:, 2]*v2[:, 2]
+
 
 LM_DIFFUSE = 1
 LM_SPECULAR = 2
@@ -418,6 +820,16 @@ LightingModel = LM_SPECULAR | LM_DIFFUSE
 ShadingModel = SM_FLAT
 UseVertexNormals = True
 
+# Rasterizer used by RenderModel(): the per-pixel scanline loop, the array based span rasterizer,
+# the span rasterizer writing a G-buffer that is lit once all the instances are drawn, or the
+# edge function rasterizer, with perspective-correct attributes.
+RM_SCANLINE = 0
+RM_SPANS = 1
+RM_DEFERRED = 2
+RM_EDGES = 3
+
+RasterizerMode = RM_SPANS
+
 def EdgeInterpolate(y0, v0, y1, v1, y2, v2):
 	v01 = Interpolate(y0, v0, y1, v1)
 	v12 = Interpolate(y1, v1, y2, v2)
@@ -428,7 +840,8 @@ def EdgeInterpolate(y0, v0, y1, v1, y2, v2):
 
 
 
-def RenderTriangle(canvas, depth_buffer, triangle, vertices, projected, camera, lights, orientation):
+# Draws a triangle that CullTriangles() kept, so back faces aren't tested again here.
+def RenderTriangle(canvas, depth_buffer, triangle, vertices, projected, scene, normal_matrix, intensities = None):
 	# Sort by projected point Y.
 	indexes = SortedVertexIndexes(triangle.indexes, projected)
 	i0, i1, i2 = indexes[0], indexes[1], indexes[2]
@@ -440,12 +853,6 @@ def RenderTriangle(canvas, depth_buffer, triangle, vertices, projected, camera,
 	# Compute triangle normal. Use the unsorted vertices, otherwise the winding of the points may change.
 	normal = ComputeTriangleNormal(vertices[triangle.indexes[0]], vertices[triangle.indexes[1]], vertices[triangle.indexes[2]])
 
-	# Backface culling.
-	vertex = vertices[triangle.indexes[0]]
-	if (Dot(vertex, normal) >= 0):
-		return
-	
-
 	# Get attribute values (X, 1/Z) at the vertices.
 	p0 = projected[triangle.indexes[i0]]
 	p1 = projected[triangle.indexes[i1]]
@@ -455,35 +862,54 @@ def RenderTriangle(canvas, depth_buffer, triangle, vertices, projected, camera,
 	x02, x012 = EdgeInterpolate(p0.y, p0.x, p1.y, p1.x, p2.y, p2.x)
 	iz02, iz012 = EdgeInterpolate(p0.y, 1.0/v0.z, p1.y, 1.0/v1.z, p2.y, 1.0/v2.z)
 
+	# Skip the triangle, before lighting it, if it's behind everything drawn over its bounding box.
+	left, top, right, bottom = canvas.window
+	origin_x, origin_y = canvas.ToScreen(0, 0)
+	hidden = None
+	if (scene.hiz != None):
+		x0, y0 = max(origin_x + int(min(min(x02), min(x012))), left), max(origin_y - p2.y, top)
+		x1, y1 = min(origin_x + int(max(max(x02), max(x012))) + 1, right), min(origin_y - p0.y + 1, bottom)
+		hidden = scene.hiz.HiddenTiles(x0, y0, x1, y1, max(max(iz02), max(iz012)))
+		if (hidden != None and hidden[0].all()):
+			if (scene.stats != None):
+				scene.stats.Count("triangles_rasterized")
+				scene.stats.Count("triangles_hiz_rejected")
+			return
+		if (hidden != None):
+			tile_size, tile_column, tile_row = scene.hiz.tile_size, hidden[1], hidden[2]
+			hidden_tiles, hidden = int(hidden[0].sum()), hidden[0].tolist()
+
 	if (UseVertexNormals):
-		transform = MultiplyMM4(Transposed(camera.orientation), orientation)
-		normal0 = MultiplyMV(transform, Vertex4(triangle.normals[i0]))
-		normal1 = MultiplyMV(transform, Vertex4(triangle.normals[i1]))
-		normal2 = MultiplyMV(transform, Vertex4(triangle.normals[i2]))
+		normal0 = MultiplyMV(normal_matrix, Vertex4(triangle.normals[i0]))
+		normal1 = MultiplyMV(normal_matrix, Vertex4(triangle.normals[i1]))
+		normal2 = MultiplyMV(normal_matrix, Vertex4(triangle.normals[i2]))
 	else:
 		normal0 = normal
 		normal1 = normal
 		normal2 = normal
 	
-	# Gouraud?
-	i02, i012 = EdgeInterpolate(p0.y, i0, p1.y, i1, p2.y, i2)
-	nx02, nx012 = EdgeInterpolate(p0.y, normal0.x, p1.y, normal1.x, p2.y, normal2.x)
-	ny02, ny012 = EdgeInterpolate(p0.y, normal0.y, p1.y, normal1.y, p2.y, normal2.y)
-	nz02, nz012 = EdgeInterpolate(p0.y, normal0.z, p1.y, normal1.z, p2.y, normal2.z)
-
 	if (ShadingModel == SM_FLAT):
 		# Flat shading: compute lighting for the entire triangle.
 		center = Vertex((v0.x + v1.x + v2.x)/3.0, (v0.y + v1.y + v2.y)/3.0, (v0.z + v1.z + v2.z)/3.0)
-		intensity = ComputeIllumination(center, normal0, camera, lights)
+		intensity = ComputeSceneIllumination(center, normal0, scene)
 	elif (ShadingModel == SM_GOURAUD):
 		# Gouraud shading: compute lighting at the vertices, and interpolate.
-		i0 = ComputeIllumination(v0, normal0, camera, lights)
-		i1 = ComputeIllumination(v1, normal1, camera, lights)
-		i2 = ComputeIllumination(v2, normal2, camera, lights)
+		if (intensities != None):
+			i0, i1, i2 = intensities[i0], intensities[i1], intensities[i2]
+		else:
+			i0 = ComputeSceneIllumination(v0, normal0, scene)
+			i1 = ComputeSceneIllumination(v1, normal1, scene)
+			i2 = ComputeSceneIllumination(v2, normal2, scene)
 	elif (ShadingModel == SM_PHONG):
 		# Phong shading: interpolate normal vectors.
 		...
 
+	# Gouraud? (Interpolated after the vertex intensities have been computed.)
+	i02, i012 = EdgeInterpolate(p0.y, i0, p1.y, i1, p2.y, i2)
+	nx02, nx012 = EdgeInterpolate(p0.y, normal0.x, p1.y, normal1.x, p2.y, normal2.x)
+	ny02, ny012 = EdgeInterpolate(p0.y, normal0.y, p1.y, normal1.y, p2.y, normal2.y)
+	nz02, nz012 = EdgeInterpolate(p0.y, normal0.z, p1.y, normal1.z, p2.y, normal2.z)
+
 
 	# Determine which is left and which is right.
 	m = int(len(x02)/2) | 0
@@ -505,113 +931,1454 @@ def RenderTriangle(canvas, depth_buffer, triangle, vertices, projected, camera,
 		nz_left, nz_right = nz012, nz02
 
 
-	# Draw horizontal segments.
-	for y in range(p0.y, p2.y+1):
-		xl, xr = int(x_left[y - p0.y]) | 0, int(x_right[y - p0.y]) | 0
+	# Draw horizontal segments. Only the rows and columns inside the frame buffer window are walked.
+	tested, written, skipped = 0, 0, 0
+	if (UseJIT and ScanlineKernel != None):
+		if (ShadingModel == SM_GOURAUD):
+			attributes_left, attributes_right = [i_left], [i_right]
+		elif (ShadingModel == SM_PHONG):
+			attributes_left, attributes_right = [nx_left, ny_left, nz_left], [nx_right, ny_right, nz_right]
+		else:
+			attributes_left, attributes_right = [], []
+		if (hidden == None):
+			hidden_mask, tile_size, tile_column, tile_row = np.zeros((0, 0), dtype=bool), 1, 0, 0
+		else:
+			hidden_mask = np.array(hidden, dtype=bool)
+
+		tested, written, skipped, xs, ys, inv_z, attributes = ScanlineKernel(canvas.pixels, depth_buffer, left, top, right, bottom, origin_x, origin_y,
+			p0.y, p2.y, np.array(x_left, dtype=float), np.array(x_right, dtype=float), np.array(iz_left, dtype=float), np.array(iz_right, dtype=float),
+			np.array(attributes_left, dtype=float).reshape(-1, len(x_left)), np.array(attributes_right, dtype=float).reshape(-1, len(x_right)),
+			np.array(triangle.color, dtype=float), ShadingModel, intensity if (ShadingModel == SM_FLAT) else 0.0, hidden_mask, tile_size, tile_column, tile_row)
+
+		# Phong: the kernel only does the depth test; the pixels it kept are lit here.
+		if (ShadingModel == SM_PHONG and written > 0):
+			positions = UnProjectVertices(canvas, xs, ys, inv_z)
+			intensity = ComputeIlluminationArray(positions, attributes, scene)
+			sx, sy = canvas.ToScreen(xs, ys)
+			canvas.pixels[sy - top, sx - left] = np.clip(np.multiply.outer(intensity, triangle.color), 0, 255).astype(int)
+	else:
+		for y in range(max(p0.y, origin_y - bottom + 1), min(p2.y, origin_y - top) + 1):
+			xl, xr = int(x_left[y - p0.y]) | 0, int(x_right[y - p0.y]) | 0
+
+			# Interpolate attributes for self scanline.
+			zl, zr = iz_left[y - p0.y], iz_right[y - p0.y]
+			zscan = Interpolate(xl, zl, xr, zr)
+		# console.log(zscan)
+
+			if (ShadingModel == SM_GOURAUD):
+				il, ir = i_left[y - p0.y], i_right[y - p0.y]
+				iscan = Interpolate(xl, il, xr, ir)
+			elif (ShadingModel == SM_PHONG):
+				nxl, nxr = nx_left[y - p0.y], nx_right[y - p0.y]
+				nyl, nyr = ny_left[y - p0.y], ny_right[y - p0.y]
+				nzl, nzr = nz_left[y - p0.y], nz_right[y - p0.y]
+
+				nxscan = Interpolate(xl, nxl, xr, nxr)
+				nyscan = Interpolate(xl, nyl, xr, nyr)
+				nzscan = Interpolate(xl, nzl, xr, nzr)
+
+			tested += max(0, min(xr, right - origin_x) - max(xl, left - origin_x))
+			for x in range(max(xl, left - origin_x), min(xr, right - origin_x)):
+				if (hidden != None and hidden[(origin_y - y - top) // tile_size - tile_row][(origin_x + x - left) // tile_size - tile_column]):
+					skipped += 1
+					continue
+
+				inv_z = zscan[x - xl]
+				if (UpdateDepthBufferIfCloser(canvas, depth_buffer, x, y, inv_z)):
+					written += 1
+
+					if (ShadingModel == SM_FLAT):
+						# Just use the per-triangle intensity.
+						...
+					elif (ShadingModel == SM_GOURAUD):
+						intensity = iscan[x-xl]
+					elif (ShadingModel == SM_PHONG):
+						vertex = UnProjectVertex(canvas, x, y, inv_z)
+						normal = Vertex(nxscan[x - xl], nyscan[x - xl], nzscan[x - xl])
+						intensity = ComputeSceneIllumination(vertex, normal, scene)
+				
+
+					PutPixel(canvas, x, y, MultiplyColor(triangle.color, intensity))
+
+	if (hidden != None and written > 0):
+		scene.hiz.Update(x0, y0, x1, y1)
+
+	if (scene.stats != None):
+		scene.stats.Count("triangles_rasterized")
+		scene.stats.Count("pixels_tested", tested - skipped)
+		scene.stats.Count("pixels_written", written)
+		scene.stats.Count("pixels_shaded", written)
+		if (hidden != None):
+			scene.stats.Count("tiles_hiz_rejected", hidden_tiles)
+			scene.stats.Count("pixels_hiz_rejected", skipped)
+
+
+
+# ======================================================================
+#    Compiled scanline kernel.
+# ======================================================================
+
+# When numba is installed, RenderTriangle() hands the pixel loop of its scanlines to a compiled
+# kernel; without it, or with UseJIT off, the loop runs in Python. The kernel is compiled the first
+# time it's called with each depth buffer type, and cached on disk next to this file, so later
+# launches only load it. WarmUpKernels() does that up front.
+UseJIT = True
+
+
+# Walks the scanlines y_start..y_end of a triangle inside the window (left, top, right, bottom)
+# of the canvas, like the loop in RenderTriangle(). The x_*, iz_* and attribute_* arrays hold the
+# values at the left and right edges of each scanline, from y_start on; attributes are the
+# Gouraud intensity, the Phong normal components, or none. Values along a scanline are
+# accumulated one step at a time like Interpolate() does, and the depth test rounds 1/z to the
+# type of the depth buffer first, like UpdateDepthBufferIfCloser() on a NumPy array, so the
+# frames match the Python loop's. Flat and Gouraud pixels are written to pixels; Phong ones are
+# returned, as canvas coordinates, 1/z and (K,3) normals, for the caller to light.
+# hidden is a HiZBuffer.HiddenTiles() mask, or an empty array. Returns (tested, written,
+# skipped) counts and the Phong pixels.
+def ScanlineSpans(pixels, depth_buffer, left, top, right, bottom, origin_x, origin_y, y_start, y_end,
+		x_left, x_right, iz_left, iz_right, attributes_left, attributes_right, color, shading, intensity,
+		hidden, tile_size, tile_column, tile_row):
+	rounded = np.empty(1, dtype=depth_buffer.dtype)
+	count = attributes_left.shape[0]
+	scan = np.empty(count)
+	steps = np.empty(count)
+
+	capacity = 0
+	if (shading == SM_PHONG):
+		capacity = (min(y_end, origin_y - top) - max(y_start, origin_y - bottom + 1) + 1) * (right - left)
+	capacity = max(capacity, 0)
+	xs = np.empty(capacity, dtype=np.int64)
+	ys = np.empty(capacity, dtype=np.int64)
+	inv_zs = np.empty(capacity)
+	normals = np.empty((capacity, count))
+
+	tested, written, skipped = 0, 0, 0
+	for y in range(max(y_start, origin_y - bottom + 1), min(y_end, origin_y - top) + 1):
+		r = y - y_start
+		xl, xr = int(x_left[r]), int(x_right[r])
+		x0, x1 = max(xl, left - origin_x), min(xr, right - origin_x)
+		if (x1 <= x0):
+			continue
+		tested += x1 - x0
+
+		zl, zr = iz_left[r], iz_right[r]
+		z, z_step = zl, (zr - zl) / (xr - xl)
+		for a in range(0, count):
+			scan[a] = attributes_left[a, r]
+			steps[a] = (attributes_right[a, r] - attributes_left[a, r]) / (xr - xl)
+
+		sy = origin_y - y
+		row = (right - left)*(sy - top)
+		for x in range(xl, x1):
+			if (x >= x0):
+				sx = origin_x + x
+				if (hidden.shape[0] > 0 and hidden[(sy - top) // tile_size - tile_row, (sx - left) // tile_size - tile_column]):
+					skipped += 1
+				else:
+					offset = (sx - left) + row
+					rounded[0] = z
+					if (depth_buffer[offset] < rounded[0]):
+						depth_buffer[offset] = z
+						if (shading == SM_PHONG):
+							xs[written] = x
+							ys[written] = y
+							inv_zs[written] = z
+							for a in range(0, count):
+								normals[written, a] = scan[a]
+						else:
+							k = intensity if (shading == SM_FLAT) else scan[0]
+							for c in range(0, 3):
+								value = color[c]*k
+								if (value < 0):
+									value = 0
+								if (value > 255):
+									value = 255
+								pixels[sy - top, sx - left, c] = int(value)
+						written += 1
+
+			z += z_step
+			for a in range(0, count):
+				scan[a] += steps[a]
+
+	if (shading != SM_PHONG):
+		written_pixels = 0
+	else:
+		written_pixels = written
+	return tested, written, skipped, xs[:written_pixels], ys[:written_pixels], inv_zs[:written_pixels], normals[:written_pixels]
+
+
+ScanlineKernel = None if (numba == None) else numba.njit(cache=True)(ScanlineSpans)
+
+
+# Compiles (or loads from the disk cache) the scanline kernel for float64 and float32 depth buffers.
+# Returns the seconds it took, or None without numba.
+def WarmUpKernels():
+	if (ScanlineKernel == None):
+		return None
+
+	start = time.perf_counter()
+	pixels = np.zeros((2, 2, 3), dtype=np.uint8)
+	edge = np.zeros(1)
+	for dtype in (np.float64, np.float32):
+		ScanlineKernel(pixels, np.zeros(4, dtype=dtype), 0, 0, 2, 2, 1, 1, 0, 0, edge, edge, edge, edge, np.zeros((0, 1)), np.zeros((0, 1)),
+			np.zeros(3), SM_FLAT, 0.0, np.zeros((0, 0), dtype=bool), 1, 0, 0)
+	return time.perf_counter() - start
+
+
+# ======================================================================
+#    Hierarchical depth buffer.
+# ======================================================================
+
+# The depth buffer holds 1/z, so larger values are closer, and 0 is the background.
+# HiZBuffer keeps the smallest and largest value of each HiZTileSize x HiZTileSize tile of it.
+# A triangle whose 1/z is nowhere larger than the smallest value of a tile can't pass the depth
+# test in it, so the rasterizers skip those tiles, or the whole triangle when it's hidden in
+# every tile it covers. Update() must be called after writing to the depth buffer.
+UseHiZ = False
+HiZTileSize = 8
+
+# Relative slack on the largest 1/z of a triangle, covering the rounding of the interpolation.
+HIZ_MARGIN = 1e-9
+
+class HiZBuffer:
+	def __init__(self, canvas, depth_buffer, tile_size = 8):
+		left, top, right, bottom = canvas.window
+		self.left, self.top = left, top
+		self.tile_size = tile_size
+		self.depth = depth_buffer.reshape(bottom - top, right - left)
+		rows, columns = -(-(bottom - top) // tile_size), -(-(right - left) // tile_size)
+		self.min = np.zeros((rows, columns))
+		self.max = np.zeros((rows, columns))
+		self.Update(left, top, right, bottom)
+
+	# Recomputes the tiles that overlap the screen rectangle [x0, x1) x [y0, y1).
+	def Update(self, x0, y0, x1, y1):
+		size = self.tile_size
+		c0, r0 = (x0 - self.left) // size, (y0 - self.top) // size
+		c1, r1 = -(-(x1 - self.left) // size), -(-(y1 - self.top) // size)
+		if (c1 <= c0 or r1 <= r0):
+			return
+
+		block = self.depth[r0*size:r1*size, c0*size:c1*size]
+		rows, columns = np.arange(0, block.shape[0], size), np.arange(0, block.shape[1], size)
+		self.min[r0:r1, c0:c1] = np.minimum.reduceat(np.minimum.reduceat(block, rows, axis=0), columns, axis=1)
+		self.max[r0:r1, c0:c1] = np.maximum.reduceat(np.maximum.reduceat(block, rows, axis=0), columns, axis=1)
+
+	# For the tiles that overlap the screen rectangle [x0, x1) x [y0, y1), whether a triangle
+	# whose largest 1/z is max_inv_z is hidden in them. Returns the (rows, columns) mask and the
+	# column and row of its first tile, or None if the rectangle is empty.
+	def HiddenTiles(self, x0, y0, x1, y1, max_inv_z):
+		size = self.tile_size
+		c0, r0 = (x0 - self.left) // size, (y0 - self.top) // size
+		c1, r1 = -(-(x1 - self.left) // size), -(-(y1 - self.top) // size)
+		if (c1 <= c0 or r1 <= r0):
+			return None
+		return self.min[r0:r1, c0:c1] >= max_inv_z*(1 + HIZ_MARGIN), c0, r0
+
+
+# ======================================================================
+#    Vectorized span rasterization.
+# ======================================================================
+
+# Array version of Interpolate(). np.add.accumulate() adds the step one value
+# at a time like the loop in Interpolate(), so both produce the same floats.
+def InterpolateArray(i0, d0, i1, d1):
+	if (i0 == i1):
+		return np.array([d0], dtype=float)
+	if (i1 < i0):
+		return np.empty(0)
+
+	values = np.full(i1 - i0 + 1, (d1 - d0) / (i1 - i0))
+	values[0] = d0
+	return np.add.accumulate(values)
+
+
+def EdgeInterpolateArray(y0, v0, y1, v1, y2, v2):
+	v01 = InterpolateArray(y0, v0, y1, v1)
+	v12 = InterpolateArray(y1, v1, y2, v2)
+	v02 = InterpolateArray(y0, v0, y2, v2)
+	return v02, np.concatenate((v01[:-1], v12))
+
+
+# Interpolates an attribute along all the scanlines of a triangle at once.
+# Row r holds the values for x = xl[r], xl[r] + 1, ..., xl[r] + width - 1.
+def SpanInterpolate(xl, xr, dl, dr, width):
+	with np.errstate(divide="ignore", invalid="ignore"):
+		step = (dr - dl) / (xr - xl)
+
+	values = np.empty((len(xl), width))
+	values[:, 0] = dl
+	values[:, 1:] = step[:, None]
+	return np.add.accumulate(values, axis=1)
+
+
+# The scanline spans of a triangle, ready to be rasterized. Row r is the scanline y0 + r,
+# from xl[r] to xr[r]; left and right hold the attributes at both ends of each row:
+# 1/z, then the Gouraud intensity or the three components of the Phong normal.
+class TriangleSpans:
+	def __init__(self, y0, xl, xr, left, right, color, intensity):
+		self.y0 = y0
+		self.xl = xl
+		self.xr = xr
+		self.left = left
+		self.right = right
+		self.color = color
+		self.intensity = intensity
+
+
+# Same as the setup part of RenderTriangle(): culls the triangle, sorts its vertices and
+# interpolates its attributes along the edges. Returns a TriangleSpans, or None if it's culled.
+# The triangle is given by its vertex indexes, its corner normals (already in camera space) and
+# its color. Vertices are [x, y, z, w] lists and projected points are [x, y] lists.
+# intensities are the Gouraud intensities at the corners, when they are already known.
+def SetupTriangleSpans(ti, normals, color, vertices, projected, scene, intensities = None):
+	# Sort by projected point Y.
+	indexes = SortedIndexes(projected[ti[0]][1], projected[ti[1]][1], projected[ti[2]][1])
+	i0, i1, i2 = indexes[0], indexes[1], indexes[2]
+
+	v0 = vertices[ti[i0]]
+	v1 = vertices[ti[i1]]
+	v2 = vertices[ti[i2]]
+
+	# Compute triangle normal. Use the unsorted vertices, otherwise the winding of the points may change.
+	a, b, c = vertices[ti[0]], vertices[ti[1]], vertices[ti[2]]
+	normal = Cross(Vertex(b[0] - a[0], b[1] - a[1], b[2] - a[2]), Vertex(c[0] - a[0], c[1] - a[1], c[2] - a[2]))
+
+	# Backface culling.
+	if (a[0]*normal.x + a[1]*normal.y + a[2]*normal.z >= 0):
+		if (scene.stats != None):
+			scene.stats.Count("triangles_backface")
+		return None
+
+	# Get attribute values (X, 1/Z) at the vertices.
+	p0 = projected[ti[i0]]
+	p1 = projected[ti[i1]]
+	p2 = projected[ti[i2]]
+
+	# Compute attribute values at the edges.
+	x02, x012 = EdgeInterpolateArray(p0[1], p0[0], p1[1], p1[0], p2[1], p2[0])
+	iz02, iz012 = EdgeInterpolateArray(p0[1], 1.0/v0[2], p1[1], 1.0/v1[2], p2[1], 1.0/v2[2])
+	edges02, edges012 = [iz02], [iz012]
+
+	if (UseVertexNormals):
+		normal0 = Vertex(normals[i0][0], normals[i0][1], normals[i0][2])
+		normal1 = Vertex(normals[i1][0], normals[i1][1], normals[i1][2])
+		normal2 = Vertex(normals[i2][0], normals[i2][1], normals[i2][2])
+	else:
+		normal0 = normal
+		normal1 = normal
+		normal2 = normal
+
+	intensity = None
+	if (ShadingModel == SM_FLAT):
+		# Flat shading: compute lighting for the entire triangle.
+		center = Vertex((v0[0] + v1[0] + v2[0])/3.0, (v0[1] + v1[1] + v2[1])/3.0, (v0[2] + v1[2] + v2[2])/3.0)
+		intensity = ComputeSceneIllumination(center, normal0, scene)
+	elif (ShadingModel == SM_GOURAUD):
+		# Gouraud shading: compute lighting at the vertices, and interpolate.
+		if (intensities != None):
+			i0, i1, i2 = intensities[i0], intensities[i1], intensities[i2]
+		else:
+			i0 = ComputeSceneIllumination(Vertex(v0[0], v0[1], v0[2]), normal0, scene)
+			i1 = ComputeSceneIllumination(Vertex(v1[0], v1[1], v1[2]), normal1, scene)
+			i2 = ComputeSceneIllumination(Vertex(v2[0], v2[1], v2[2]), normal2, scene)
+		i02, i012 = EdgeInterpolateArray(p0[1], i0, p1[1], i1, p2[1], i2)
+		edges02.append(i02)
+		edges012.append(i012)
+	elif (ShadingModel == SM_PHONG):
+		# Phong shading: interpolate normal vectors.
+		for n0, n1, n2 in ((normal0.x, normal1.x, normal2.x), (normal0.y, normal1.y, normal2.y), (normal0.z, normal1.z, normal2.z)):
+			n02, n012 = EdgeInterpolateArray(p0[1], n0, p1[1], n1, p2[1], n2)
+			edges02.append(n02)
+			edges012.append(n012)
+
+	# Determine which is left and which is right.
+	m = len(x02) // 2
+	if (x02[m] < x012[m]):
+		return TriangleSpans(p0[1], x02.astype(int), x012.astype(int), edges02, edges012, color, intensity)
+	else:
+		return TriangleSpans(p0[1], x012.astype(int), x02.astype(int), edges012, edges02, color, intensity)
+
+
+# Rasterizes the spans of a triangle into the frame buffer window. The covered pixels of all
+# the scanlines are laid out as one 2D block, then depth tested and written together.
+# With an id_buffer (one value per pixel, like the depth buffer), span_id is stored for the
+# pixels that are written. With reshade, the depth test is replaced by a lookup: only the pixels
+# whose id is span_id are shaded, and the depth and id buffers are left as they are.
+# With a gbuffer, the pixels are not shaded: their attributes are stored for ShadeGBuffer().
+# With depth_only, only the depth and id buffers are written.
+# A TriangleEdges given instead of the spans is drawn by RasterizeEdges(), with the same options.
+def RasterizeSpans(canvas, depth_buffer, spans, scene, id_buffer = None, span_id = -1, reshade = False, gbuffer = None, depth_only = False):
+	if (isinstance(spans, TriangleEdges)):
+		return RasterizeEdges(canvas, depth_buffer, spans, scene, id_buffer, span_id, reshade, gbuffer, depth_only)
+
+	left, top, right, bottom = canvas.window
+	origin_x, origin_y = canvas.ToScreen(0, 0)
+
+	# Keep the rows inside the window, and stop each row at the right edge of the window.
+	r0 = max(0, origin_y - bottom + 1 - spans.y0)
+	r1 = min(len(spans.xl), origin_y - top + 1 - spans.y0)
+	if (r1 <= r0):
+		return
+
+	xl = spans.xl[r0:r1]
+	xr = spans.xr[r0:r1]
+	count = np.minimum(xr, right - origin_x) - xl
+	width = count.max()
+	if (width <= 0):
+		return
+
+	# Skip the spans, or the tiles of them, that are behind everything drawn there.
+	hidden = None
+	if (scene.hiz != None and not reshade):
+		x0, y0 = max(origin_x + int(xl.min()), left), origin_y - (spans.y0 + r1 - 1)
+		x1, y1 = origin_x + int((xl + count).max()), origin_y - (spans.y0 + r0) + 1
+		max_inv_z = max(spans.left[0][r0:r1].max(), spans.right[0][r0:r1].max())
+		hidden = scene.hiz.HiddenTiles(x0, y0, x1, y1, max_inv_z)
+		if (hidden != None and hidden[0].all()):
+			if (scene.stats != None):
+				scene.stats.Count("triangles_hiz_rejected")
+			return
+
+	columns = np.arange(width)
+	covered = columns < count[:, None]
+	xs = (xl[:, None] + columns)[covered]
+	ys = np.broadcast_to(np.arange(spans.y0 + r0, spans.y0 + r1)[:, None], covered.shape)[covered]
+	inv_z = SpanInterpolate(xl, xr, spans.left[0][r0:r1], spans.right[0][r0:r1], width)[covered]
+
+	sx, sy = canvas.ToScreen(xs, ys)
+	selected, offset = DepthTestPixels(canvas, depth_buffer, scene, sx, sy, inv_z, hidden, id_buffer, span_id, reshade)
+	if (depth_only or len(selected) == 0):
+		return
 
-		# Interpolate attributes for self scanline.
-		zl, zr = iz_left[y - p0.y], iz_right[y - p0.y]
-		zscan = Interpolate(xl, zl, xr, zr)
-	# console.log(zscan)
+	attributes = [SpanInterpolate(xl, xr, spans.left[a][r0:r1], spans.right[a][r0:r1], width)[covered][selected] for a in range(1, len(spans.left))]
+	ShadePixels(canvas, scene, spans.color, spans.intensity, attributes, xs[selected], ys[selected], sx[selected], sy[selected], inv_z[selected], offset[selected], gbuffer)
+
+
+# Depth tests the pixels at screen coordinates (sx, sy), whose 1/z is inv_z, and writes the
+# depth and id buffers as described in RasterizeSpans(). Pixels outside the window, or in the
+# hidden tiles of a HiZBuffer.HiddenTiles() result, are skipped. Returns the indexes of the
+# pixels to shade and the depth buffer offsets of all the pixels.
+def DepthTestPixels(canvas, depth_buffer, scene, sx, sy, inv_z, hidden, id_buffer, span_id, reshade):
+	left, top, right, bottom = canvas.window
+	on_screen = (sx >= left) & (sy >= top)
+	offset = (sx - left) + (right - left)*(sy - top)
+	selected = np.flatnonzero(on_screen)
+
+	if (hidden != None and hidden[0].any()):
+		mask, tile_column, tile_row = hidden
+		skipped = mask[(sy[selected] - top) // scene.hiz.tile_size - tile_row, (sx[selected] - left) // scene.hiz.tile_size - tile_column]
+		if (scene.stats != None):
+			scene.stats.Count("tiles_hiz_rejected", int(mask.sum()))
+			scene.stats.Count("pixels_hiz_rejected", int(skipped.sum()))
+		selected = selected[~skipped]
+
+	if (reshade):
+		selected = selected[id_buffer[offset[selected]] == span_id]
+	else:
+		# 1/z is rounded to the type of the depth buffer before the test, as the scalar loop does.
+		closer = depth_buffer[offset[selected]] < inv_z[selected].astype(depth_buffer.dtype)
+		if (scene.stats != None):
+			scene.stats.Count("pixels_tested", len(selected))
+			scene.stats.Count("pixels_written", int(closer.sum()))
+		selected = selected[closer]
+		depth_buffer[offset[selected]] = inv_z[selected]
+		if (id_buffer is not None):
+			id_buffer[offset[selected]] = span_id
+		if (hidden != None and len(selected)):
+			scene.hiz.Update(sx[selected].min(), sy[selected].min(), sx[selected].max() + 1, sy[selected].max() + 1)
+	return selected, offset
+
+
+# Shades the pixels a triangle won, or stores them in gbuffer. color and intensity are the ones of
+# the triangle; attributes are the Gouraud intensity or the Phong normal components at the pixels.
+# The other arrays give the canvas and screen coordinates, 1/z and depth buffer offsets of them.
+def ShadePixels(canvas, scene, color, intensity, attributes, xs, ys, sx, sy, inv_z, offset, gbuffer):
+	left, top, right, bottom = canvas.window
+	if (gbuffer is not None):
+		gbuffer.color[offset] = color
+		if (ShadingModel == SM_FLAT):
+			gbuffer.intensity[offset] = intensity
+		elif (ShadingModel == SM_GOURAUD):
+			gbuffer.intensity[offset] = attributes[0]
+		elif (ShadingModel == SM_PHONG):
+			gbuffer.normal[offset] = np.stack(attributes, axis=1)
+			gbuffer.inv_z[offset] = inv_z
+		return
 
+	if (scene.stats != None):
+		scene.stats.Count("pixels_shaded", len(offset))
+	if (ShadingModel == SM_FLAT):
+		# Just use the per-triangle intensity.
+		colors = np.array(MultiplyColor(color, intensity)).astype(int)
+	else:
 		if (ShadingModel == SM_GOURAUD):
-			il, ir = i_left[y - p0.y], i_right[y - p0.y]
-			iscan = Interpolate(xl, il, xr, ir)
+			intensity = attributes[0]
 		elif (ShadingModel == SM_PHONG):
-			nxl, nxr = nx_left[y - p0.y], nx_right[y - p0.y]
-			nyl, nyr = ny_left[y - p0.y], ny_right[y - p0.y]
-			nzl, nzr = nz_left[y - p0.y], nz_right[y - p0.y]
-
-			nxscan = Interpolate(xl, nxl, xr, nxr)
-			nyscan = Interpolate(xl, nyl, xr, nyr)
-			nzscan = Interpolate(xl, nzl, xr, nzr)
-
-		for x in range(xl, xr):
-			inv_z = zscan[x - xl]
-			if (UpdateDepthBufferIfCloser(canvas, depth_buffer, x, y, inv_z)):
-
-				if (ShadingModel == SM_FLAT):
-					# Just use the per-triangle intensity.
-					...
-				elif (ShadingModel == SM_GOURAUD):
-					intensity = iscan[x-xl]
-				elif (ShadingModel == SM_PHONG):
-					vertex = UnProjectVertex(canvas, x, y, inv_z)
-					normal = Vertex(nxscan[x - xl], nyscan[x - xl], nzscan[x - xl])
-					intensity = ComputeIllumination(vertex, normal, camera, lights)
-				
+			normals = np.stack(attributes, axis=1)
+			positions = UnProjectVertices(canvas, xs, ys, inv_z)
+			intensity = ComputeIlluminationArray(positions, normals, scene)
+		colors = np.clip(np.multiply.outer(intensity, color), 0, 255).astype(int)
+
+	canvas.pixels[sy - top, sx - left] = colors
+
+
+# ======================================================================
+#    Edge function rasterization.
+# ======================================================================
 
-				PutPixel(canvas, x, y, MultiplyColor(triangle.color, intensity))
+# A triangle ready for RasterizeEdges(): its projected corners as a (3,2) array, 1/z at them,
+# and the attributes to interpolate as a (3,A) array: nothing (Flat), the Gouraud intensity,
+# or the three components of the Phong normal.
+class TriangleEdges:
+	def __init__(self, points, inv_z, attributes, color, intensity):
+		self.points = points
+		self.inv_z = inv_z
+		self.attributes = attributes
+		self.color = color
+		self.intensity = intensity
 
 
+# Square blocks of pixels RasterizeEdges() evaluates the edge functions over at once.
+EdgeBlockSize = 32
 
-# Clips a triangle against a plane. Adds output to triangles and vertices.
-def ClipTriangle(triangle, plane, triangles, vertices):
-	v0 = vertices[triangle.indexes[0]]
-	v1 = vertices[triangle.indexes[1]]
-	v2 = vertices[triangle.indexes[2]]
 
-	in0 = Dot(plane.normal, v0) + plane.distance > 0
-	in1 = Dot(plane.normal, v1) + plane.distance > 0
-	in2 = Dot(plane.normal, v2) + plane.distance > 0
+# Same as SetupTriangleSpans(), but sets the triangle up for RasterizeEdges(). Lighting is done
+# the same way; only the interpolation is left to the rasterizer. Returns None for back faces,
+# and for triangles that project to a line, which cover no pixel.
+def SetupTriangleEdges(ti, normals, color, vertices, projected, scene, intensities = None):
+	# Compute triangle normal.
+	a, b, c = vertices[ti[0]], vertices[ti[1]], vertices[ti[2]]
+	normal = Cross(Vertex(b[0] - a[0], b[1] - a[1], b[2] - a[2]), Vertex(c[0] - a[0], c[1] - a[1], c[2] - a[2]))
 
-	in_count = in0 + in1 + in2
-	if (in_count == 0):
-		# Nothing to do - the triangle is fully clipped out.
-		...
-	elif (in_count == 3):
-		# The triangle is fully in front of the plane.
-		triangles.append(triangle)
-	elif (in_count == 1):
-		# The triangle has one vertex in. Output is one clipped triangle.
-		...
-	elif (in_count == 2):
-		# The triangle has two vertices in. Output is two clipped triangles.
-		...
+	# Backface culling.
+	if (a[0]*normal.x + a[1]*normal.y + a[2]*normal.z >= 0):
+		if (scene.stats != None):
+			scene.stats.Count("triangles_backface")
+		return None
 
+	points = np.array([projected[ti[0]], projected[ti[1]], projected[ti[2]]], dtype=float)
+	if ((points[1, 0] - points[0, 0])*(points[2, 1] - points[0, 1]) == (points[1, 1] - points[0, 1])*(points[2, 0] - points[0, 0])):
+		return None
 
-def TransformAndClip(clipping_planes, model, scale, transform):
+	if (UseVertexNormals):
+		corner_normals = [Vertex(n[0], n[1], n[2]) for n in normals]
+	else:
+		corner_normals = [normal, normal, normal]
+
+	intensity = None
+	attributes = np.zeros((3, 0))
+	if (ShadingModel == SM_FLAT):
+		# Flat shading: compute lighting for the entire triangle.
+		center = Vertex((a[0] + b[0] + c[0])/3.0, (a[1] + b[1] + c[1])/3.0, (a[2] + b[2] + c[2])/3.0)
+		intensity = ComputeSceneIllumination(center, corner_normals[0], scene)
+	elif (ShadingModel == SM_GOURAUD):
+		# Gouraud shading: compute lighting at the vertices, and interpolate.
+		if (intensities == None):
+			intensities = [ComputeSceneIllumination(Vertex(v[0], v[1], v[2]), n, scene) for v, n in zip((a, b, c), corner_normals)]
+		attributes = np.array(intensities, dtype=float).reshape(3, 1)
+	elif (ShadingModel == SM_PHONG):
+		# Phong shading: interpolate normal vectors.
+		attributes = np.array([[n.x, n.y, n.z] for n in corner_normals])
+
+	return TriangleEdges(points, np.array([1.0/a[2], 1.0/b[2], 1.0/c[2]]), attributes, color, intensity)
+
+
+# Rasterizes a triangle by evaluating its three edge functions over its bounding box, one
+# EdgeBlockSize block at a time; blocks entirely outside one of the edges are skipped.
+# E[k](x, y) is twice the area of the triangle formed by (x, y) and the edge opposite to corner
+# k, so E[k] / area are the barycentric coordinates of the pixel. 1/z is linear in them; the
+# attributes are interpolated as attribute/z and divided by 1/z, which is perspective-correct.
+# Pixels on an edge shared by two triangles are drawn by only one of them. Takes the same
+# options as RasterizeSpans().
+def RasterizeEdges(canvas, depth_buffer, edges, scene, id_buffer = None, span_id = -1, reshade = False, gbuffer = None, depth_only = False):
+	left, top, right, bottom = canvas.window
+	origin_x, origin_y = canvas.ToScreen(0, 0)
+	points = edges.points
+
+	# Bounding box in canvas coordinates, inside the window.
+	x0, x1 = max(int(points[:, 0].min()), left - origin_x), min(int(points[:, 0].max()) + 1, right - origin_x)
+	y0, y1 = max(int(points[:, 1].min()), origin_y - bottom + 1), min(int(points[:, 1].max()) + 1, origin_y - top + 1)
+	if (x1 <= x0 or y1 <= y0):
+		return
+
+	# E[k](x, y) = a[k]*x + b[k]*y + c[k], for the edge from corner k + 1 to corner k + 2,
+	# oriented so that the inside of the triangle is positive.
+	start, end = points[[1, 2, 0]], points[[2, 0, 1]]
+	a = start[:, 1] - end[:, 1]
+	b = end[:, 0] - start[:, 0]
+	c = -(a*start[:, 0] + b*start[:, 1])
+	area = a[0]*points[0, 0] + b[0]*points[0, 1] + c[0]
+	if (area < 0):
+		a, b, c, area = -a, -b, -c, -area
+
+	# The corners are whole pixels, so E is a whole number at every pixel. An edge owns the
+	# pixels on it when its inside normal points right, or straight up; the other edges need E >= 1.
+	bias = np.where((a > 0) | ((a == 0) & (b > 0)), 0, 1)
+
+	hidden = None
+	if (scene.hiz != None and not reshade):
+		hidden = scene.hiz.HiddenTiles(origin_x + x0, origin_y - (y1 - 1), origin_x + x1, origin_y - y0 + 1, edges.inv_z.max())
+		if (hidden != None and hidden[0].all()):
+			if (scene.stats != None):
+				scene.stats.Count("triangles_hiz_rejected")
+			return
+
+	for by in range(y0, y1, EdgeBlockSize):
+		ys = np.arange(by, min(by + EdgeBlockSize, y1))
+		for bx in range(x0, x1, EdgeBlockSize):
+			xs = np.arange(bx, min(bx + EdgeBlockSize, x1))
+
+			# E is linear, so its largest value over the block is at one of the corners.
+			largest = np.maximum(a*xs[0], a*xs[-1]) + np.maximum(b*ys[0], b*ys[-1]) + c
+			if ((largest < bias).any()):
+				continue
+
+			e = a[:, None, None]*xs + b[:, None, None]*ys[:, None] + c[:, None, None]
+			rows, columns = np.nonzero((e >= bias[:, None, None]).all(axis=0))
+			if (len(rows) == 0):
+				continue
+
+			# Sums written out, rather than matrix products, so every pixel gets the same floats
+			# whatever the block and tile it's in.
+			weights = e[:, rows, columns] / area
+			inv_z = edges.inv_z[0]*weights[0] + edges.inv_z[1]*weights[1] + edges.inv_z[2]*weights[2]
+			px, py = xs[columns], ys[rows]
+			sx, sy = canvas.ToScreen(px, py)
+			selected, offset = DepthTestPixels(canvas, depth_buffer, scene, sx, sy, inv_z, hidden, id_buffer, span_id, reshade)
+			if (depth_only or len(selected) == 0):
+				continue
+
+			# Perspective-correct weights: the barycentric coordinates divided by z, over 1/z.
+			perspective = weights[:, selected]*edges.inv_z[:, None] / inv_z[selected]
+			corners = edges.attributes
+			attributes = [corners[0, k]*perspective[0] + corners[1, k]*perspective[1] + corners[2, k]*perspective[2] for k in range(0, corners.shape[1])]
+			ShadePixels(canvas, scene, edges.color, edges.intensity, attributes, px[selected], py[selected], sx[selected], sy[selected], inv_z[selected], offset[selected], gbuffer)
+
+
+# The camera-space vertices, projected points, camera-space corner normals, vertex indexes and
+# colors of a transformed model, as the plain lists SetupTriangleSpans() works with.
+# With Gouraud shading, the corner intensities of all the triangles are computed the first time
+# a triangle is set up for a scene (see LightModelVertices()), and reused for the others.
+class ModelGeometry:
+	def __init__(self, canvas, model, normal_matrix):
+		# Project all the vertices and rotate all the normals in one step.
+		normals = TransformNormals(normal_matrix, model.normal_array)
+		projected = ProjectVertices(canvas, model.vertex_array)
+		self.canvas = canvas
+		self.vertices = model.vertex_array.tolist()
+		self.projected = projected.tolist()
+		self.projected_array = projected
+		self.normals = normals.tolist()
+		self.indexes = model.index_array.tolist()
+		self.colors = model.color_array.tolist()
+
+		self.arrays = (model.vertex_array, model.index_array, normals)
+		self.index_array = model.index_array
+		self.lit_scene = None
+		self.intensities = None
+
+	def Intensities(self, t, scene):
+		if (ShadingModel != SM_GOURAUD or not UseVertexNormals):
+			return None
+		if (self.lit_scene is not scene):
+			self.intensities = LightModelVertices(*self.arrays, scene).tolist()
+			self.lit_scene = scene
+		return self.intensities[t]
+
+	def SetupSpans(self, t, scene):
+		return SetupTriangleSpans(self.indexes[t], self.normals[t], self.colors[t], self.vertices, self.projected, scene, self.Intensities(t, scene))
+
+	def SetupEdges(self, t, scene):
+		return SetupTriangleEdges(self.indexes[t], self.normals[t], self.colors[t], self.vertices, self.projected, scene, self.Intensities(t, scene))
+
+
+# Gouraud lighting of a transformed model: each distinct pair of a vertex and a corner normal is
+# lit once, all of them together. On a smooth mesh that's once per vertex instead of once per
+# corner, about six times less. vertices is the (N,4) camera-space vertex array, indexes the
+# (T,3) vertex indexes and normals the (T,3,3) camera-space corner normals. Returns the (T,3)
+# intensities at the corners.
+def LightModelVertices(vertices, indexes, normals, scene):
+	corners = np.concatenate((indexes.reshape(-1, 1), normals.reshape(-1, 3)), axis=1)
+	unique, inverse = np.unique(corners, axis=0, return_inverse=True)
+	intensity = ComputeIlluminationArray(vertices[unique[:, 0].astype(int), :3], unique[:, 1:], scene)
+	return intensity[inverse.reshape(-1)].reshape(-1, 3)
+
+
+# Drops the back faces, degenerate triangles and triangles outside the window of a whole model at
+# once. Returns the indexes of the kept triangles and their (K,4) (left, top, right, bottom) boxes.
+def CullTriangles(canvas, vertices, indexes, projected, stats = None, zero_area = False):
+	a, b, c = vertices[indexes[:, 0]], vertices[indexes[:, 1]], vertices[indexes[:, 2]]
+	ab, ac = b - a, c - a
+	nx = ab[:, 1]*ac[:, 2] - ab[:, 2]*ac[:, 1]
+	ny = ab[:, 2]*ac[:, 0] - ab[:, 0]*ac[:, 2]
+	nz = ab[:, 0]*ac[:, 1] - ab[:, 1]*ac[:, 0]
+	flat = (nx == 0) & (ny == 0) & (nz == 0)
+	front = a[:, 0]*nx + a[:, 1]*ny + a[:, 2]*nz < 0
+
+	p = projected[indexes]
+	if (zero_area):
+		# Twice the signed area of the projected triangles; the projected points are whole pixels.
+		collapsed = (p[:, 1, 0] - p[:, 0, 0])*(p[:, 2, 1] - p[:, 0, 1]) == (p[:, 1, 1] - p[:, 0, 1])*(p[:, 2, 0] - p[:, 0, 0])
+	else:
+		collapsed = (p[:, 0] == p[:, 1]).all(axis=1) & (p[:, 1] == p[:, 2]).all(axis=1)
+	degenerate = flat | (front & collapsed)
+
+	origin_x, origin_y = canvas.ToScreen(0, 0)
+	lower, upper = p.min(axis=1), p.max(axis=1)
+	bounds = np.stack((origin_x + lower[:, 0], origin_y - upper[:, 1], origin_x + upper[:, 0] + 1, origin_y - lower[:, 1] + 1), axis=1)
+	left, top, right, bottom = canvas.window
+	outside = (bounds[:, 2] + 1 <= left) | (bounds[:, 0] - 1 >= right) | (bounds[:, 3] + 1 <= top) | (bounds[:, 1] - 1 >= bottom)
+	offscreen = front & ~degenerate & outside
+
+	keep = front & ~degenerate & ~offscreen
+	if (stats != None):
+		stats.Count("triangles_backface", int((~front & ~flat).sum()))
+		stats.Count("triangles_degenerate", int(degenerate.sum()))
+		stats.Count("triangles_offscreen", int(offscreen.sum()))
+	visible = np.flatnonzero(keep)
+	return visible, bounds[visible]
+
+
+# Sets up the spans of all the triangles of a transformed model, in order. Back faces are dropped.
+# With RM_EDGES, the triangles are set up for RasterizeEdges() instead.
+def SetupModelSpans(canvas, model, scene, normal_matrix):
+	return [spans for t, spans, bounds in SetupGeometrySpans(ModelGeometry(canvas, model, normal_matrix), scene, RasterizerMode == RM_EDGES)]
+
+
+# Returns (triangle, spans, bounds) for the triangles of a ModelGeometry that CullTriangles() keeps,
+# or (triangle, edges, bounds) with edges. bounds is the (left, top, right, bottom) screen box of
+# the triangle's corners, which holds all of its pixels.
+def SetupGeometrySpans(geometry, scene, edges = False):
+	visible, bounds = CullTriangles(geometry.canvas, geometry.arrays[0], geometry.index_array, geometry.projected_array, scene.stats, edges)
+	spans = []
+	for t, box in zip(visible.tolist(), bounds.tolist()):
+		triangle_spans = geometry.SetupEdges(t, scene) if (edges) else geometry.SetupSpans(t, scene)
+		if (triangle_spans != None):
+			spans.append((t, triangle_spans, tuple(box)))
+
+	if (scene.stats != None):
+		scene.stats.Count("triangles_rasterized", len(spans))
+	return spans
+
+
+
+# Reorders the corners of each triangle so that corner first[t] comes first, keeping the winding.
+def RotateCorners(array, first):
+	order = (first[:, None] + np.arange(3)) % 3
+	return np.take_along_axis(array, order.reshape(order.shape + (1,)*(array.ndim - 2)), axis=1)
+
+
+# Clips all the triangles against a plane at once, Sutherland-Hodgman style. The vertices
+# created on the plane are appended to the vertex array, with the corner normals interpolated
+# the same way. Returns the new (vertices, indexes, normals, colors), in the original triangle order.
+def ClipTriangles(plane, vertices, indexes, normals, colors, stats = None):
+	n = plane.normal
+	distance = n.x*vertices[:, 0] + n.y*vertices[:, 1] + n.z*vertices[:, 2] + plane.distance
+	corners_in = (distance > 0)[indexes]
+	in_count = corners_in.sum(axis=1)
+	if (stats != None):
+		stats.Count("triangles_outside", int((in_count == 0).sum()))
+		stats.Count("triangles_clipped", int(((in_count == 1) | (in_count == 2)).sum()))
+
+	# in_count == 3: the triangle is fully in front of the plane, keep it.
+	# in_count == 0: nothing to do - the triangle is fully clipped out.
+	full = np.flatnonzero(in_count == 3)
+	if (len(full) == len(indexes)):
+		return vertices, indexes, normals, colors
+
+	# in_count == 1: rotate the vertex inside to A. Output is one clipped triangle A B' C'.
+	one = np.flatnonzero(in_count == 1)
+	first = np.argmax(corners_in[one], axis=1)
+	one_indexes = RotateCorners(indexes[one], first)
+	one_normals = RotateCorners(normals[one], first)
+
+	# in_count == 2: rotate the vertex outside to C. Output is two clipped triangles A B B' and A B' A'.
+	two = np.flatnonzero(in_count == 2)
+	first = (np.argmin(corners_in[two], axis=1) + 1) % 3
+	two_indexes = RotateCorners(indexes[two], first)
+	two_normals = RotateCorners(normals[two], first)
+
+	# Intersect the edges (inside corner, outside corner) with the plane.
+	inner = np.concatenate((one_indexes[:, 0], one_indexes[:, 0], two_indexes[:, 0], two_indexes[:, 1]))
+	outer = np.concatenate((one_indexes[:, 1], one_indexes[:, 2], two_indexes[:, 2], two_indexes[:, 2]))
+	inner_normals = np.concatenate((one_normals[:, 0], one_normals[:, 0], two_normals[:, 0], two_normals[:, 1]))
+	outer_normals = np.concatenate((one_normals[:, 1], one_normals[:, 2], two_normals[:, 2], two_normals[:, 2]))
+
+	t = (distance[inner] / (distance[inner] - distance[outer]))[:, None]
+	new_vertices = vertices[inner] + t*(vertices[outer] - vertices[inner])
+	new_normals = inner_normals + t*(outer_normals - inner_normals)
+
+	k1, k2 = len(one), len(two)
+	new_index = len(vertices) + np.arange(len(inner))
+	b1, c1 = new_index[:k1], new_index[k1:2*k1]
+	a2, b2 = new_index[2*k1:2*k1 + k2], new_index[2*k1 + k2:]
+	n_b1, n_c1 = new_normals[:k1], new_normals[k1:2*k1]
+	n_a2, n_b2 = new_normals[2*k1:2*k1 + k2], new_normals[2*k1 + k2:]
+
+	out_indexes = np.concatenate((
+		indexes[full],
+		np.stack((one_indexes[:, 0], b1, c1), axis=1),
+		np.stack((two_indexes[:, 0], two_indexes[:, 1], b2), axis=1),
+		np.stack((two_indexes[:, 0], b2, a2), axis=1)))
+	out_normals = np.concatenate((
+		normals[full],
+		np.stack((one_normals[:, 0], n_b1, n_c1), axis=1),
+		np.stack((two_normals[:, 0], two_normals[:, 1], n_b2), axis=1),
+		np.stack((two_normals[:, 0], n_b2, n_a2), axis=1)))
+
+	# Put the output back in the order of the input triangles.
+	source = np.concatenate((full, one, two, two))
+	order = np.argsort(source, kind="stable")
+	return np.concatenate((vertices, new_vertices)), out_indexes[order], out_normals[order], colors[source[order]]
+
+
+def TransformAndClip(clipping_planes, model, scale, transform, stats = None):
 	# Transform the bounding sphere, and attempt early discard.
 	center = MultiplyMV(transform, Vertex4(model.bounds_center))
 	radius = model.bounds_radius*scale
 	for p in range(0, len(clipping_planes)):
 		distance = Dot(clipping_planes[p].normal, center) + clipping_planes[p].distance
 		if (distance < -radius):
+			if (stats != None):
+				stats.Count("instances_culled")
 			return None
 
-	# Apply modelview transform.
-	vertices = []
-	for i in range(0, len(model.vertices)):
-		vertices.append(MultiplyMV(transform, Vertex4(model.vertices[i])))
+	# Apply modelview transform to all the vertices at once.
+	return ClipModel(clipping_planes, model, MultiplyMVArray(transform, model.vertex_array), center, stats)
+
+
+# Clips the triangles of a model, given its transformed (N,4) vertices and bounding sphere center.
+def ClipModel(clipping_planes, model, vertices, center, stats = None):
+	if (stats != None):
+		stats.Count("triangles", len(model.index_array))
 
 	# Clip the entire model against each successive plane.
-	triangles = model.triangles.copy()
+	indexes, normals, colors = model.index_array, model.normal_array, model.color_array
 	for p in range(0, len(clipping_planes)):
-		new_triangles = []
-		for i in range(0, len(triangles)):
-			ClipTriangle(triangles[i], clipping_planes[p], new_triangles, vertices)
-		
-		triangles = new_triangles
+		vertices, indexes, normals, colors = ClipTriangles(clipping_planes[p], vertices, indexes, normals, colors, stats)
+
+	return ClippedModel(vertices, indexes, normals, colors, center, model.bounds_radius)
 
-	return Model(vertices, triangles, center, model.bounds_radius)
 
+# Largest number of instances of a model transformed in one batch by TransformAndClipInstances().
+InstanceBatchSize = 256
 
-def RenderModel(canvas, depth_buffer, model, camera, lights, orientation):
-	projected = []
-	for i in range(0, len(model.vertices)):
-		projected.append(ProjectVertex(canvas, Vertex4(model.vertices[i])))
-	for i in range(0, len(model.triangles)):
-		RenderTriangle(canvas, depth_buffer, model.triangles[i], model.vertices, projected, camera, lights, orientation)
 
+# Same as TransformAndClip() on each instance, with its model-view matrix from transforms.
+# Returns the list of clipped models, None for the culled instances. The instances are grouped by
+# model: the bounding spheres of a group are tested against all the planes at once, and the
+# vertices of the instances that pass are transformed in batches of InstanceBatchSize.
+def TransformAndClipInstances(clipping_planes, instances, transforms, stats = None):
+	plane_normals = np.array([[p.normal.x, p.normal.y, p.normal.z] for p in clipping_planes], dtype=float).reshape(-1, 3)
+	plane_distances = np.array([p.distance for p in clipping_planes], dtype=float)
 
-def RenderScene(canvas, depth_buffer, camera, instances, lights):
-	cameraMatrix = MultiplyMM4(Transposed(camera.orientation), MakeTranslationMatrix(Multiply(-1, camera.position)))
+	groups = collections.OrderedDict()
+	for i in range(0, len(instances)):
+		groups.setdefault(id(instances[i].model), []).append(i)
+
+	clipped = [None]*len(instances)
+	for members in groups.values():
+		model = instances[members[0]].model
+		c = model.bounds_center
+		for b in range(0, len(members), InstanceBatchSize):
+			batch = np.array(members[b:b + InstanceBatchSize])
+			matrices = np.array([transforms[i].data for i in batch], dtype=float)
+
+			# Transform the bounding spheres, and discard the instances fully behind any plane.
+			centers = MultiplyMVBatch(matrices, np.array([[c.x, c.y, c.z, 1.0]]))[:, 0]
+			distances = (centers[:, 0, None]*plane_normals[:, 0] + centers[:, 1, None]*plane_normals[:, 1] + centers[:, 2, None]*plane_normals[:, 2]) + plane_distances
+			radius = np.array([model.bounds_radius*instances[i].scale for i in batch])
+			visible = ~(distances < -radius[:, None]).any(axis=1)
+			if (stats != None):
+				stats.Count("instances_culled", int(len(batch) - visible.sum()))
+			if (not visible.any()):
+				continue
+
+			# Only the planes crossing the bounding sphere can clip triangles; the sphere is in front
+			# of the others (with some margin for rounding).
+			crossing = (distances <= radius[:, None]*(1 + 1e-6))[visible].tolist()
+
+			vertices = MultiplyMVBatch(matrices[visible], model.vertex_array)
+			centers = centers[visible].tolist()
+			for k, i in enumerate(batch[visible].tolist()):
+				planes = [clipping_planes[p] for p in range(0, len(clipping_planes)) if crossing[k][p]]
+				clipped[i] = ClipModel(planes, model, vertices[k], Vertex4(*centers[k]), stats)
+
+	return clipped
+
+
+# Returns True if an optional cancel event has been set.
+def IsCancelled(cancel):
+	return cancel != None and cancel.is_set()
+
+
+# With RM_DEFERRED, the pixels go to gbuffer instead, for ShadeGBuffer() to light.
+# Returns False if cancel is set before the model is drawn.
+def RenderModel(canvas, depth_buffer, model, scene, normal_matrix, cancel = None, gbuffer = None):
+	if (RasterizerMode != RM_SCANLINE):
+		start = time.perf_counter()
+		spans = SetupModelSpans(canvas, model, scene, normal_matrix)
+		if (scene.stats != None):
+			scene.stats.AddTime("setup", start)
+
+		start = time.perf_counter()
+		for i in range(0, len(spans)):
+			if (IsCancelled(cancel)):
+				return False
+			RasterizeSpans(canvas, depth_buffer, spans[i], scene, gbuffer=gbuffer)
+		if (scene.stats != None):
+			scene.stats.AddTime("raster", start)
+	else:
+		start = time.perf_counter()
+		vertices = [Vertex4(v[0], v[1], v[2], v[3]) for v in model.vertex_array.tolist()]
+		projected_array = ProjectVertices(canvas, model.vertex_array)
+		projected = [Pt(p[0], p[1], None) for p in projected_array.tolist()]
+
+		# Gouraud: light all the vertices up front, each one once.
+		intensities = None
+		if (ShadingModel == SM_GOURAUD and UseVertexNormals):
+			intensities = LightModelVertices(model.vertex_array, model.index_array, TransformNormals(normal_matrix, model.normal_array), scene).tolist()
+
+		# Only the triangles that survive culling reach RenderTriangle().
+		visible = CullTriangles(canvas, model.vertex_array, model.index_array, projected_array, scene.stats)[0]
+		indexes, normals, colors = model.index_array.tolist(), model.normal_array.tolist(), model.color_array.tolist()
+		for i in visible.tolist():
+			if (IsCancelled(cancel)):
+				return False
+			triangle = Triangle(indexes[i], colors[i], [Vertex(n[0], n[1], n[2]) for n in normals[i]])
+			RenderTriangle(canvas, depth_buffer, triangle, vertices, projected, scene, normal_matrix, None if (intensities == None) else intensities[i])
+		if (scene.stats != None):
+			scene.stats.AddTime("raster", start)
+
+	return True
+
+
+# ======================================================================
+#    Deferred shading.
+# ======================================================================
+
+# Per-pixel attributes of a frame buffer window, laid out like the depth buffer: the base color,
+# the intensity (Flat and Gouraud, where lighting is done per triangle or per vertex), the
+# interpolated camera-space normal and 1/z (Phong), from which ShadeGBuffer() reconstructs the
+# camera-space position. 1/z is kept at full precision, since the depth buffer may round it to
+# float32. Only the last triangle written to a pixel counts, so each visible pixel is lit exactly
+# once however many times it's overdrawn.
+# Only the attributes the current ShadingModel needs are allocated; the others are None.
+class GBuffer:
+	def __init__(self, canvas):
+		left, top, right, bottom = canvas.window
+		size = (right - left)*(bottom - top)
+		phong = (ShadingModel == SM_PHONG)
+		self.color = np.zeros((size, 3), dtype=np.uint8)
+		self.intensity = None if phong else np.zeros(size)
+		self.normal = np.zeros((size, 3)) if phong else None
+		self.inv_z = np.zeros(size) if phong else None
+
+
+# Lights the pixels of a G-buffer that were drawn (1/z > 0 in the depth buffer) into the canvas.
+# Gives the same colors RasterizeSpans() computes when it shades the pixels itself.
+def ShadeGBuffer(canvas, depth_buffer, gbuffer, scene):
+	left, top, right, bottom = canvas.window
+	drawn = np.flatnonzero(depth_buffer > 0)
+	if (scene.stats != None):
+		scene.stats.Count("pixels_shaded", len(drawn))
+
+	if (ShadingModel == SM_PHONG):
+		origin_x, origin_y = canvas.ToScreen(0, 0)
+		xs = drawn % (right - left) + left - origin_x
+		ys = origin_y - (drawn // (right - left) + top)
+		positions = UnProjectVertices(canvas, xs, ys, gbuffer.inv_z[drawn])
+		intensity = ComputeIlluminationArray(positions, gbuffer.normal[drawn], scene)
+	else:
+		intensity = gbuffer.intensity[drawn]
+
+	colors = np.clip(intensity[:, None]*gbuffer.color[drawn], 0, 255).astype(int)
+	canvas.pixels.reshape(-1, 3)[drawn] = colors
+
+
+# Copies the values of a window (left, top, right, bottom) from an array laid out like the depth
+# buffer of that window, into the array of a width x height frame. Values can be scalars or rows.
+def PasteWindow(frame, values, window, width, height):
+	left, top, right, bottom = window
+	shape = values.shape[1:]
+	frame.reshape((height, width) + shape)[top:bottom, left:right] = values.reshape((bottom - top, right - left) + shape)
+
+
+# ======================================================================
+#    Scene hierarchy.
+# ======================================================================
+
+# World-space bounding spheres of instances, as (K,3) centers and (K,) radii.
+def InstanceSpheres(instances):
+	transforms = np.array([instance.transform.data for instance in instances], dtype=float).reshape(-1, 4, 4)
+	centers = np.array([[c.x, c.y, c.z, 1.0] for c in (instance.model.bounds_center for instance in instances)]).reshape(-1, 4)
+	radii = np.array([instance.model.bounds_radius*instance.scale for instance in instances], dtype=float)
+	return np.einsum("kij,kj->ki", transforms, centers)[:, :3], radii
+
+
+# Clipping planes of a camera in world space, as (P,3) normals and (P,) distances.
+def WorldPlanes(camera, clipping_planes):
+	rotation = np.array(camera.orientation.data, dtype=float)[:3, :3]
+	position = np.array([camera.position.x, camera.position.y, camera.position.z])
+	normals = np.array([[p.normal.x, p.normal.y, p.normal.z] for p in clipping_planes], dtype=float).reshape(-1, 3) @ rotation.T
+	distances = np.array([p.distance for p in clipping_planes], dtype=float) - normals @ position
+	return normals, distances
+
+
+# A bounding volume hierarchy over the bounding spheres of instances. Nodes are axis aligned
+# boxes; each one covers the instances order[start:start + count], and leaves hold up to
+# leaf_size of them. Children always come after their parent in the node arrays.
+# Cull() returns the instances that may be visible, nearest first, so the depth test rejects
+# more of the farther ones. Refit() updates the boxes when some instances move, keeping the tree.
+class InstanceBVH:
+	def __init__(self, instances, leaf_size = 4):
+		self.leaf_size = leaf_size
+		self.centers, self.radii = InstanceSpheres(instances)
+		self.order = np.arange(len(instances))
+
+		# Split the instances at the median of the longest axis of their centers, top down.
+		start, count, self.left, self.right, self.parent = [0], [len(instances)], [-1], [-1], [-1]
+		stack = [0]
+		while (stack):
+			n = stack.pop()
+			if (count[n] <= leaf_size):
+				continue
+
+			members = self.order[start[n]:start[n] + count[n]]
+			centers = self.centers[members]
+			axis = np.argmax(centers.max(axis=0) - centers.min(axis=0))
+			half = count[n] // 2
+			self.order[start[n]:start[n] + count[n]] = members[np.argpartition(centers[:, axis], half)]
+
+			for child_start, child_count in ((start[n], half), (start[n] + half, count[n] - half)):
+				start.append(child_start)
+				count.append(child_count)
+				self.left.append(-1)
+				self.right.append(-1)
+				self.parent.append(n)
+				stack.append(len(start) - 1)
+			self.left[n], self.right[n] = len(start) - 2, len(start) - 1
+
+		self.start = np.array(start)
+		self.count = np.array(count)
+		self.left = np.array(self.left)
+		self.right = np.array(self.right)
+		self.leaf_of = np.empty(len(instances), dtype=int)
+		for n in np.flatnonzero(self.left < 0).tolist():
+			self.leaf_of[self.order[self.start[n]:self.start[n] + self.count[n]]] = n
+
+		self.lower = np.zeros((len(start), 3))
+		self.upper = np.zeros((len(start), 3))
+		self.UpdateBounds(range(len(start) - 1, -1, -1))
+
+	# Recomputes the boxes of the given nodes, which must come children first. The only leaf that
+	# can be empty is the root of a tree with no instances; its box is left as it is.
+	def UpdateBounds(self, nodes):
+		for n in nodes:
+			if (self.left[n] < 0):
+				members = self.order[self.start[n]:self.start[n] + self.count[n]]
+				if (len(members) == 0):
+					continue
+				radii = self.radii[members, None]
+				self.lower[n] = (self.centers[members] - radii).min(axis=0)
+				self.upper[n] = (self.centers[members] + radii).max(axis=0)
+			else:
+				self.lower[n] = np.minimum(self.lower[self.left[n]], self.lower[self.right[n]])
+				self.upper[n] = np.maximum(self.upper[self.left[n]], self.upper[self.right[n]])
+
+	# Updates the spheres of the moved instances (a list of indexes, or None for all of them) and
+	# the boxes of their leaves and ancestors. The tree isn't rebuilt, so it's cheap when few
+	# instances move, but its boxes grow looser as instances wander from where they were.
+	def Refit(self, instances, moved = None):
+		if (moved == None):
+			self.centers, self.radii = InstanceSpheres(instances)
+			self.UpdateBounds(range(len(self.start) - 1, -1, -1))
+			return
+
+		self.centers[moved], self.radii[moved] = InstanceSpheres([instances[i] for i in moved])
+		nodes = set()
+		for n in self.leaf_of[moved].tolist():
+			while (n >= 0 and n not in nodes):
+				nodes.add(n)
+				n = self.parent[n]
+		self.UpdateBounds(sorted(nodes, reverse=True))
+
+	# Returns the indexes of the instances whose bounding spheres aren't fully behind one of the
+	# clipping planes, sorted front to back. The boxes are tested one tree level at a time; the
+	# planes a box is fully in front of aren't tested again below it.
+	def Cull(self, camera, clipping_planes, stats = None):
+		if (len(self.centers) == 0):
+			return []
+
+		normals, distances = WorldPlanes(camera, clipping_planes)
+		margin = 1e-9
+		positive = normals > 0
+
+		nodes = np.array([0])
+		active = np.ones((1, len(distances)), dtype=bool)
+		visible = []
+		while (len(nodes)):
+			lower, upper = self.lower[nodes, None, :], self.upper[nodes, None, :]
+			far = (np.where(positive, upper, lower)*normals).sum(axis=2) + distances
+			near = (np.where(positive, lower, upper)*normals).sum(axis=2) + distances
+			keep = ~((far < -margin) & active).any(axis=1)
+			nodes, active = nodes[keep], (active & ~(near > margin))[keep]
+
+			# Boxes in front of all the planes are visible with everything below them.
+			inside = ~active.any(axis=1)
+			for n in nodes[inside].tolist():
+				visible.append(self.order[self.start[n]:self.start[n] + self.count[n]])
+
+			# Leaves that cross a plane: test the spheres of their instances.
+			leaves = ~inside & (self.left[nodes] < 0)
+			for n, planes in zip(nodes[leaves].tolist(), active[leaves]):
+				members = self.order[self.start[n]:self.start[n] + self.count[n]]
+				d = self.centers[members] @ normals[planes].T + distances[planes]
+				visible.append(members[~(d < -self.radii[members, None] - margin).any(axis=1)])
+
+			inner = ~inside & ~leaves
+			nodes, active = np.concatenate((self.left[nodes[inner]], self.right[nodes[inner]])), np.concatenate((active[inner], active[inner]))
+
+		visible = np.concatenate(visible) if (visible) else np.zeros(0, dtype=int)
+		if (stats != None):
+			stats.Count("instances_culled", len(self.centers) - len(visible))
+
+		# Front to back: by the camera-space depth of the nearest point of each sphere.
+		rotation = np.array(camera.orientation.data, dtype=float)[:3, :3]
+		position = np.array([camera.position.x, camera.position.y, camera.position.z])
+		depth = (self.centers[visible] - position) @ rotation[:, 2] - self.radii[visible]
+		return visible[np.argsort(depth, kind="stable")].tolist()
+
+
+# Rasterizes spans in two passes: the first one only writes the depth buffer, and records which
+# triangle is closest at each pixel; the second one shades just those pixels. Each visible pixel
+# is shaded once, whatever the draw order, and triangles left with no pixels aren't walked again.
+def RasterizeEarlyZ(canvas, depth_buffer, spans, scene, cancel = None):
+	left, top, right, bottom = canvas.window
+	ids = np.full((right - left)*(bottom - top), -1, dtype=np.int64)
+	for i in range(0, len(spans)):
+		if (IsCancelled(cancel)):
+			return
+		RasterizeSpans(canvas, depth_buffer, spans[i], scene, ids, i, depth_only=True)
+
+	visible = np.unique(ids)
+	for i in visible[visible >= 0].tolist():
+		if (IsCancelled(cancel)):
+			return
+		RasterizeSpans(canvas, depth_buffer, spans[i], scene, ids, i, reshade=True)
+
+
+# ======================================================================
+#    Tiled rendering.
+# ======================================================================
+
+# Scene traversal options of RenderScene(). With UseBVH, an InstanceBVH is built for each frame
+# (unless one is given) to cull the instances and draw them front to back. With EarlyZ, the
+# span and edge rasterizers draw the whole frame with RasterizeEarlyZ(); it's not used with tiles.
+UseBVH = False
+EarlyZ = False
+
+# When TileWorkers > 0, RenderScene() sets up the triangles of all the instances, bins them
+# into TileSize x TileSize screen tiles, and rasterizes the tiles in a pool of TileWorkers
+# processes. Each tile keeps the triangles in scene order, so the frame is the same as the
+# one RM_SPANS or RM_EDGES draws in a single process. Only used with those two.
+TileWorkers = 0
+TileSize = 128
+
+TilePools = {}
+
+
+def GetTilePool(workers):
+	if (workers not in TilePools):
+		TilePools[workers] = concurrent.futures.ProcessPoolExecutor(max_workers=workers)
+	return TilePools[workers]
+
+
+# Returns the windows (left, top, right, bottom) of the tiles covering a frame buffer.
+def MakeTiles(canvas, tile_size):
+	left, top, right, bottom = canvas.window
+	tiles = []
+	for y in range(top, bottom, tile_size):
+		for x in range(left, right, tile_size):
+			tiles.append((x, y, min(x + tile_size, right), min(y + tile_size, bottom)))
+
+	return tiles
+
+
+# Rasterizes the spans overlapping one tile into the tile's own color and depth buffers.
+# Runs in a worker process, so the shading settings travel with the job, and the counters
+# of the tile come back in a fresh FrameStats.
+def RenderTile(job):
+	global ShadingModel, LightingModel
+	window, width, height, viewport, pixels, depth_buffer, spans, scene, ShadingModel, LightingModel, hiz_tile_size = job
+	if (scene.stats != None):
+		scene.stats = FrameStats()
+
+	tile = FrameBuffer(width, height, window=window, viewport=viewport)
+	tile.pixels[:, :] = pixels
+	if (hiz_tile_size != None):
+		scene.hiz = HiZBuffer(tile, depth_buffer, hiz_tile_size)
+	for i in range(0, len(spans)):
+		RasterizeSpans(tile, depth_buffer, spans[i], scene)
+
+	return window, tile.pixels, depth_buffer, scene.stats
+
+
+# Renders spans in tiles, in the worker processes. bounds are the screen boxes of the spans, as
+# SetupGeometrySpans() gives them.
+def RenderTiles(canvas, depth_buffer, spans, bounds, scene):
+	left, top, right, bottom = canvas.window
+	depth = depth_buffer.reshape(bottom - top, right - left)
+	bounds = np.array(bounds, dtype=int).reshape(-1, 4)
+
+	# Bin the triangles into tiles; each job carries its tile's slice of the color and depth buffers.
+	jobs = []
+	for window in MakeTiles(canvas, TileSize):
+		x0, y0, x1, y1 = window
+		overlap = np.flatnonzero((bounds[:, 0] < x1) & (bounds[:, 2] > x0) & (bounds[:, 1] < y1) & (bounds[:, 3] > y0))
+		if (len(overlap) == 0):
+			continue
+
+		pixels = canvas.pixels[y0 - top:y1 - top, x0 - left:x1 - left].copy()
+		tile_depth = depth[y0 - top:y1 - top, x0 - left:x1 - left].flatten()
+		jobs.append((window, canvas.width, canvas.height, canvas.viewport_size, pixels, tile_depth, [spans[i] for i in overlap], scene, ShadingModel, LightingModel, HiZTileSize if (UseHiZ) else None))
+
+	for window, pixels, tile_depth, tile_stats in GetTilePool(TileWorkers).map(RenderTile, jobs):
+		if (tile_stats != None):
+			scene.stats.Merge(tile_stats)
+		x0, y0, x1, y1 = window
+		canvas.pixels[y0 - top:y1 - top, x0 - left:x1 - left] = pixels
+		depth[y0 - top:y1 - top, x0 - left:x1 - left] = tile_depth.reshape(y1 - y0, x1 - x0)
+
+
+# Renders the instances into the canvas, which can be a FrameBuffer or a PIL image.
+# cancel is an optional threading.Event: once it's set, rendering stops and False is returned.
+# stats is an optional FrameStats that the counters and stage times of the frame are added to.
+# bvh is an optional InstanceBVH of the instances, kept up to date by the caller.
+def RenderScene(canvas, depth_buffer, camera, instances, lights, cancel = None, stats = None, bvh = None):
+	frame_start = time.perf_counter()
+	if (stats == None and StatsCallback != None):
+		stats = FrameStats()
+
+	framebuffer = AsFrameBuffer(canvas)
+	scene = PreparedScene(camera, lights, instances)
+	scene.stats = stats
+	SelectLevelsOfDetail(framebuffer.width, instances, scene.transforms, framebuffer.viewport_size)
+	tiled = (TileWorkers > 0 and RasterizerMode in (RM_SPANS, RM_EDGES))
+	if (UseHiZ and not tiled):
+		scene.hiz = HiZBuffer(framebuffer, depth_buffer, HiZTileSize)
+	early_z = (EarlyZ and RasterizerMode in (RM_SPANS, RM_EDGES) and not tiled)
+	gbuffer = GBuffer(framebuffer) if (RasterizerMode == RM_DEFERRED) else None
+	if (stats != None):
+		stats.Count("instances", len(instances))
+		stats.AddTime("prepare", frame_start)
+
+	# Draw order: all the instances in list order, or the ones the hierarchy keeps, front to back.
+	start = time.perf_counter()
+	order = list(range(0, len(instances)))
+	if (bvh == None and UseBVH):
+		bvh = InstanceBVH(instances)
+	if (bvh != None):
+		order = bvh.Cull(camera, camera.clipping_planes, stats)
+
+	models = TransformAndClipInstances(camera.clipping_planes, [instances[i] for i in order], [scene.transforms[i] for i in order], stats)
+	if (stats != None):
+		stats.AddTime("clip", start)
+
+	spans, bounds = [], []
+	for k in range(0, len(order)):
+		if (IsCancelled(cancel)):
+			return False
+
+		i = order[k]
+		clipped = models[k]
+		if (clipped == None):
+			continue
+
+		if (tiled or early_z):
+			start = time.perf_counter()
+			setup = SetupGeometrySpans(ModelGeometry(framebuffer, clipped, scene.normal_matrices[i]), scene, RasterizerMode == RM_EDGES)
+			spans.extend(s for t, s, box in setup)
+			bounds.extend(box for t, s, box in setup)
+			if (stats != None):
+				stats.AddTime("setup", start)
+		elif (not RenderModel(framebuffer, depth_buffer, clipped, scene, scene.normal_matrices[i], cancel, gbuffer)):
+			return False
+
+	if (IsCancelled(cancel)):
+		return False
+
+	if (gbuffer is not None):
+		start = time.perf_counter()
+		ShadeGBuffer(framebuffer, depth_buffer, gbuffer, scene)
+		if (stats != None):
+			stats.AddTime("shade", start)
+
+	if (tiled):
+		start = time.perf_counter()
+		RenderTiles(framebuffer, depth_buffer, spans, bounds, scene)
+		if (stats != None):
+			stats.AddTime("raster", start)
+
+	if (early_z):
+		start = time.perf_counter()
+		RasterizeEarlyZ(framebuffer, depth_buffer, spans, scene, cancel)
+		if (stats != None):
+			stats.AddTime("raster", start)
+		if (IsCancelled(cancel)):
+			return False
+
+	if (framebuffer is not canvas):
+		canvas.frombytes(framebuffer.pixels.tobytes())
+
+	if (stats != None):
+		stats.frames += 1
+		stats.AddTime("frame", frame_start)
+		if (StatsCallback != None):
+			StatsCallback(stats)
+
+	return True
+
+
+# ======================================================================
+#    Incremental rendering.
+# ======================================================================
 
+# A FrameCache keeps a frame along with what it was made of, so the next frame can reuse it:
+# the ModelGeometry and screen bounds of each instance, and an id buffer with the triangle
+# that won each pixel (-1 for the background). Triangle ids are
+# instance*INSTANCE_ID_STRIDE + triangle, and stay valid while the instance doesn't move.
+# When only the lights change, ReshadeCachedFrame() shades the visible pixels again, keeping
+# the geometry, depth and ids. When instances move, SetupCachedGeometry() followed by
+# RasterizeCachedWindow() over the union of their old and new bounds redraws only that region.
+# Both give the same pixels RenderScene() draws with RM_SPANS. With Phong shading the frame is
+# drawn through a G-buffer that the cache keeps, so new lights only need ShadeGBuffer().
+INSTANCE_ID_STRIDE = 1 << 24
+
+
+class FrameCache:
+	def __init__(self, width, height, background = (255, 255, 255), viewport = None):
+		self.background = background
+		self.canvas = FrameBuffer(width, height, background, viewport=viewport)
+		self.depth_buffer = np.zeros(width*height, dtype=np.float32)
+		self.ids = np.full(width*height, -1, dtype=np.int64)
+		self.gbuffer = GBuffer(self.canvas) if (ShadingModel == SM_PHONG) else None
+		self.geometry = []
+		self.bounds = []
+		self.spans = []
+
+
+# Transforms, clips and sets up all the instances, replacing the geometry, bounds and spans of the cache.
+def SetupCachedGeometry(cache, scene, instances):
+	start = time.perf_counter()
+	cache.geometry, cache.bounds, cache.spans = [], [], []
+	models = TransformAndClipInstances(scene.camera.clipping_planes, instances, scene.transforms, scene.stats)
 	for i in range(0, len(instances)):
-		transform = MultiplyMM4(cameraMatrix, instances[i].transform)
-		clipped = TransformAndClip(camera.clipping_planes, instances[i].model, instances[i].scale, transform)
-		if (clipped != None):
-			RenderModel(canvas, depth_buffer, clipped, camera, lights, instances[i].orientation)
+		clipped = models[i]
+		if (clipped == None):
+			cache.geometry.append(None)
+			cache.bounds.append(None)
+			continue
+
+		geometry = ModelGeometry(cache.canvas, clipped, scene.normal_matrices[i])
+		setup = SetupGeometrySpans(geometry, scene)
+		cache.geometry.append(geometry)
+		cache.bounds.append(UnionBounds([bounds for t, s, bounds in setup]))
+		cache.spans.extend((i*INSTANCE_ID_STRIDE + t, s) for t, s, bounds in setup)
+
+	if (scene.stats != None):
+		scene.stats.Count("instances", len(instances))
+		scene.stats.AddTime("setup", start)
+
+
+# Smallest (left, top, right, bottom) rectangle holding all the given ones; None ones are skipped.
+def UnionBounds(bounds):
+	bounds = [b for b in bounds if b != None]
+	if (len(bounds) == 0):
+		return None
+	return (min(b[0] for b in bounds), min(b[1] for b in bounds), max(b[2] for b in bounds), max(b[3] for b in bounds))
+
+
+# Clears a window (left, top, right, bottom) of the cached frame and rasterizes the cached spans
+# into it. Returns False if cancel is set before it's finished; the cache is then incomplete.
+def RasterizeCachedWindow(cache, scene, window, cancel = None):
+	canvas = cache.canvas
+	left, top, right, bottom = max(window[0], 0), max(window[1], 0), min(window[2], canvas.width), min(window[3], canvas.height)
+	if (right <= left or bottom <= top):
+		return True
+
+	start = time.perf_counter()
+	window = (left, top, right, bottom)
+	tile = FrameBuffer(canvas.width, canvas.height, cache.background, window, canvas.viewport_size)
+	depth_buffer = np.zeros((bottom - top)*(right - left), dtype=cache.depth_buffer.dtype)
+	ids = np.full((bottom - top)*(right - left), -1, dtype=np.int64)
+	gbuffer = GBuffer(tile) if (cache.gbuffer is not None) else None
+	for span_id, spans in cache.spans:
+		if (IsCancelled(cancel)):
+			return False
+
+		# Skip the instances outside the window.
+		b = cache.bounds[span_id // INSTANCE_ID_STRIDE]
+		if (b[0] >= right or b[2] <= left or b[1] >= bottom or b[3] <= top):
+			continue
+		RasterizeSpans(tile, depth_buffer, spans, scene, ids, span_id, gbuffer=gbuffer)
+
+	if (gbuffer is not None):
+		ShadeGBuffer(tile, depth_buffer, gbuffer, scene)
+		PasteWindow(cache.gbuffer.color, gbuffer.color, window, canvas.width, canvas.height)
+		PasteWindow(cache.gbuffer.normal, gbuffer.normal, window, canvas.width, canvas.height)
+		PasteWindow(cache.gbuffer.inv_z, gbuffer.inv_z, window, canvas.width, canvas.height)
+
+	canvas.pixels[top:bottom, left:right] = tile.pixels
+	PasteWindow(cache.depth_buffer, depth_buffer, window, canvas.width, canvas.height)
+	PasteWindow(cache.ids, ids, window, canvas.width, canvas.height)
+	if (scene.stats != None):
+		scene.stats.AddTime("raster", start)
+	return True
+
+
+# Shades the visible pixels of the cached frame again with the lights of scene, which must have
+# the same camera and instance transforms as the cached frame.
+def ReshadeCachedFrame(cache, scene, cancel = None):
+	start = time.perf_counter()
+	done = ReshadeVisiblePixels(cache, scene, cancel)
+	if (scene.stats != None):
+		scene.stats.AddTime("reshade", start)
+	return done
+
+
+def ReshadeVisiblePixels(cache, scene, cancel):
+	if (cache.gbuffer is not None):
+		ShadeGBuffer(cache.canvas, cache.depth_buffer, cache.gbuffer, scene)
+		return True
+
+	visible, inverse = np.unique(cache.ids, return_inverse=True)
+	if (ShadingModel == SM_FLAT):
+		# Each pixel takes the color of its triangle: build the table of colors, and look it up.
+		colors = np.zeros((len(visible), 3), dtype=np.uint8)
+		for k in range(0, len(visible)):
+			if (IsCancelled(cancel)):
+				return False
+			if (visible[k] >= 0):
+				spans = cache.geometry[visible[k] // INSTANCE_ID_STRIDE].SetupSpans(visible[k] % INSTANCE_ID_STRIDE, scene)
+				colors[k] = np.array(MultiplyColor(spans.color, spans.intensity)).astype(int)
+
+		covered = np.flatnonzero(cache.ids >= 0)
+		if (scene.stats != None):
+			scene.stats.Count("pixels_shaded", len(covered))
+		cache.canvas.pixels.reshape(-1, 3)[covered] = colors[inverse.reshape(-1)[covered]]
+		return True
+
+	for span_id in visible[visible >= 0].tolist():
+		if (IsCancelled(cancel)):
+			return False
+
+		geometry = cache.geometry[span_id // INSTANCE_ID_STRIDE]
+		spans = geometry.SetupSpans(span_id % INSTANCE_ID_STRIDE, scene)
+		RasterizeSpans(cache.canvas, cache.depth_buffer, spans, scene, cache.ids, span_id, True)
+
+	return True
 
 
 # ----- Sphere model generator -----
@@ -645,6 +2412,24 @@ def GenerateSphere(divs, color):
 	return Model(vertices, triangles, Vertex(0, 0, 0), 1.0)
 
 
+# Same sphere as GenerateSphere(), built directly as a PackedMesh.
+def GenerateSpherePacked(divs, color):
+	angles = np.arange(divs)*(2.0*math.pi / divs)
+	y = (2.0 / divs) * (np.arange(divs + 1) - divs/2)
+	radius = np.sqrt(1.0 - y*y)
+	positions = np.stack((np.outer(radius, np.cos(angles)), np.repeat(y[:, None], divs, axis=1), np.outer(radius, np.sin(angles))), axis=2).reshape(-1, 3)
+
+	# Two triangles per quad, in the order GenerateSphere() makes them.
+	d, i = np.divmod(np.arange(divs*divs), divs)
+	i0 = d*divs + i
+	i1 = (d + 1)*divs + (i + 1) % divs
+	i2 = divs*d + (i + 1) % divs
+	indexes = np.stack((np.stack((i0, i1, i2), axis=1), np.stack((i0, i0 + divs, i1), axis=1)), axis=1).reshape(-1, 3)
+
+	# The normals of a unit sphere are its positions.
+	return PackedMesh(positions, positions[indexes], indexes, np.tile(color, (len(indexes), 1)), Vertex(0, 0, 0), 1.0)
+
+
 vertices = [
 	Vertex(1, 1, 1),
 	Vertex(-1, 1, 1),
@@ -676,4 +2461,142 @@ triangles = [
 	Triangle([5, 0, 4], PURPLE, [Vertex( 0,    1,    0), Vertex( 0,    1,    0), Vertex( 0,    1,    0)]),
 	Triangle([2, 6, 7], CYAN,     [Vertex( 0, -1,    0), Vertex( 0, -1,    0), Vertex( 0, -1,    0)]),
 	Triangle([2, 7, 3], CYAN,     [Vertex( 0, -1,    0), Vertex( 0, -1,    0), Vertex( 0, -1,    0)]),
-]
\ No newline at end of file
+]
+
+
+# ======================================================================
+#    Mesh cache.
+# ======================================================================
+
+# Builds the model for a shape: "Cube" (divs and color are ignored, each face has its own
+# color) or "Sphere" with the given number of divisions. With packed, it's a PackedMesh.
+def MakeMesh(shape, divs, color, packed = False):
+	if (shape == "Cube"):
+		model = Model(vertices, triangles, Vertex(0, 0, 0), math.sqrt(3))
+		return PackModel(model) if (packed) else model
+	elif (shape == "Sphere"):
+		return GenerateSpherePacked(divs, color) if (packed) else GenerateSphere(divs, color)
+
+	raise ValueError("Unknown shape: %s" % shape)
+
+
+# Makes a model read-only, so it can be shared by every instance and every frame.
+def FreezeModel(model):
+	if (isinstance(model, PackedMesh)):
+		for array in (model.positions, model.normals, model.indexes, model.colors):
+			array.flags.writeable = False
+		return model
+
+	model.vertices = tuple(model.vertices)
+	model.triangles = tuple(model.triangles)
+	model.vertex_array.flags.writeable = False
+	model.index_array.flags.writeable = False
+	model.normal_array.flags.writeable = False
+	model.color_array.flags.writeable = False
+	return model
+
+
+# A bounded LRU cache of packed, read-only models, keyed by (shape, divs, color).
+# Counts hits and misses, and the time spent generating models on misses.
+# With packed, the models are PackedMesh, which take a fraction of the memory.
+class MeshRegistry:
+	def __init__(self, capacity = 16, packed = False):
+		self.capacity = capacity
+		self.packed = packed
+		self.models = collections.OrderedDict()
+		self.lock = threading.Lock()
+		self.hits = 0
+		self.misses = 0
+		self.generation_time = 0.0
+
+	def Get(self, shape, divs = 0, color = None):
+		key = (shape, divs, None if color is None else tuple(color))
+		with self.lock:
+			if (key in self.models):
+				self.hits += 1
+				self.models.move_to_end(key)
+				return self.models[key]
+
+			self.misses += 1
+			start = time.perf_counter()
+			model = FreezeModel(MakeMesh(shape, divs, color, self.packed))
+			self.generation_time += time.perf_counter() - start
+
+			self.models[key] = model
+			if (len(self.models) > self.capacity):
+				self.models.popitem(last=False)
+
+			return model
+
+	def Stats(self):
+		return {"hits": self.hits, "misses": self.misses, "size": len(self.models), "generation_time": self.generation_time}
+
+
+Meshes = MeshRegistry()
+
+
+# ======================================================================
+#    Level of detail.
+# ======================================================================
+
+# Fraction of a level's radius range the projected radius must leave it by before the level
+# changes, so an instance near a threshold doesn't switch levels back and forth.
+LODHysteresis = 0.1
+
+# The tessellations of a shape, from the finest: levels is a list of (divs, min_radius), and
+# level i is used while the projected radius of the instance, in pixels, is at least min_radius
+# (the last one should be 0). The models come from Meshes, so they are generated once.
+class MeshLOD:
+	def __init__(self, shape, levels, color = None):
+		self.levels = levels
+		self.models = [Meshes.Get(shape, divs, color) for divs, min_radius in levels]
+		self.current = {}
+
+	# Level for a projected radius, given the level the instance had, if any.
+	def Level(self, radius, previous = None):
+		level = 0
+		while (level < len(self.levels) - 1 and radius < self.levels[level][1]):
+			level += 1
+
+		if (previous != None and previous != level):
+			lower = self.levels[previous][1]
+			upper = self.levels[previous - 1][1] if (previous > 0) else math.inf
+			if (lower*(1 - LODHysteresis) <= radius < upper*(1 + LODHysteresis)):
+				return previous
+		return level
+
+	# Level for the instance key on a canvas width pixels wide. Each canvas width keeps its own
+	# levels, so previews at other sizes don't change the levels of the full size frames.
+	def Select(self, key, radius, width = None):
+		level = self.Level(radius, self.current.get((key, width)))
+		if (key != None):
+			self.current[(key, width)] = level
+		return self.models[level]
+
+
+# Projected radius in pixels, on a canvas width pixels wide showing a viewport viewport units wide
+# (None for the module's viewport_size), of the bounding spheres of the instances, given their
+# model-view transforms. Spheres that reach the camera plane get an infinite radius.
+def ProjectedRadii(width, instances, transforms, viewport = None):
+	viewport = viewport_size if (viewport == None) else viewport
+	transforms = np.array([transform.data for transform in transforms], dtype=float).reshape(-1, 4, 4)
+	centers = np.array([[c.x, c.y, c.z, 1.0] for c in (instance.model.bounds_center for instance in instances)]).reshape(-1, 4)
+	z = np.einsum("kj,kj->k", transforms[:, 2, :], centers)
+	radii = np.array([instance.model.bounds_radius*instance.scale for instance in instances], dtype=float)
+
+	with np.errstate(divide="ignore"):
+		projected = radii*projection_plane_z/z * width/viewport
+	return np.where(z > radii, projected, math.inf)
+
+
+# Gives each instance with a MeshLOD the level that fits its projected size on a canvas width
+# pixels wide (showing a viewport viewport units wide, as in ProjectedRadii()). transforms are
+# the model-view matrices of the instances, as in PreparedScene.
+def SelectLevelsOfDetail(width, instances, transforms, viewport = None):
+	selected = [i for i in range(0, len(instances)) if instances[i].lod != None]
+	if (len(selected) == 0):
+		return
+
+	instances = [instances[i] for i in selected]
+	for instance, radius in zip(instances, ProjectedRadii(width, instances, [transforms[i] for i in selected], viewport).tolist()):
+		instance.model = instance.lod.Select(instance.lod_key, radius, width)
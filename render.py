@@ -0,0 +1,127 @@
+import argparse
+import concurrent.futures
+import copy
+import itertools
+import json
+import os
+import numpy as np
+from examen3 import LightData, CameraData, FigureData, StartPage, figureGrid
+
+
+# Renders frames without the Tk window. A scene file is a JSON object like:
+#
+#	{
+#		"shading": "Phong",
+#		"size": 601,
+#		"camera": {"x": 0, "y": 0, "z": 0, "rotation": 0},
+#		"lights": [{"x": 2, "y": 3, "z": 0, "intensity": 90}],
+#		"figures": [
+#			{"type": "Sphere", "x": -1, "y": 0, "z": 6, "scale": 1, "rotation": 0},
+#			{"type": "Cube", "x": 1.5, "y": 0, "z": 6, "scale": 1, "rotation": 30},
+#			{"type": "Cube", "z": 12, "scale": 0.3, "grid": [20, 1, 20], "spacing": 1}
+#		],
+#		"sweeps": [{"parameter": "figures.1.rotation", "start": -180, "stop": 180, "steps": 36}]
+#	}
+#
+# Missing values take the defaults of LightData, CameraData and FigureData. A figure with a grid
+# stands for nx * ny * nz copies of it, spacing apart (see examen3.figureGrid()). A sweep sets the
+# parameter at the given path (object keys and list indexes separated by dots) to each of steps
+# evenly spaced values, start and stop included. Several sweeps render every combination.
+
+
+SCENE_DEFAULTS = {"shading": "Flat", "size": 601, "camera": {}, "lights": [{}], "figures": [{}], "sweeps": []}
+
+
+def LoadScene(path):
+	with open(path) as scene_file:
+		scene = json.load(scene_file)
+	for key, value in SCENE_DEFAULTS.items():
+		scene.setdefault(key, value)
+	return scene
+
+
+# "figures.0.rotation=-180:180:36" -> sweep of the rotation of the first figure.
+def ParseSweep(text):
+	parameter, _, values = text.partition("=")
+	start, stop, steps = values.split(":")
+	return {"parameter": parameter, "start": float(start), "stop": float(stop), "steps": int(steps)}
+
+
+def SetParameter(scene, parameter, value):
+	keys = [int(key) if key.isdigit() else key for key in parameter.split(".")]
+	target = scene
+	for key in keys[:-1]:
+		target = target[key]
+	target[keys[-1]] = value
+
+
+# Expands the sweeps of a scene into the list of scenes of every frame.
+def ExpandSweeps(scene):
+	sweeps = scene["sweeps"]
+	values = [np.linspace(sweep["start"], sweep["stop"], sweep["steps"]).tolist() for sweep in sweeps]
+
+	frames = []
+	for combination in itertools.product(*values):
+		frame = copy.deepcopy(scene)
+		for sweep, value in zip(sweeps, combination):
+			SetParameter(frame, sweep["parameter"], value)
+		frames.append(frame)
+	return frames
+
+
+def BuildRenderData(scene):
+	lights = [LightData(light.get("x", 1), light.get("y", 1), light.get("z", 1), light.get("intensity", 1)) for light in scene["lights"]]
+	camera = scene["camera"]
+	camera = CameraData(camera.get("x", 0), camera.get("y", 0), camera.get("z", 0), camera.get("rotation", 0))
+	figures = []
+	for figure in scene["figures"]:
+		figure_data = FigureData(figure.get("type", "Cube"), figure.get("x", 0), figure.get("y", 0), figure.get("z", 5), figure.get("scale", 1), figure.get("rotation", 0))
+		if "grid" in figure:
+			figures.extend(figureGrid(figure_data, figure["grid"], figure.get("spacing", 2.5*figure_data.scale)))
+		else:
+			figures.append(figure_data)
+	return lights, camera, figures
+
+
+# Renders one frame and writes it to path. Runs in the worker processes.
+def RenderFrame(job):
+	scene, path = job
+	StartPage.setLighthing(scene["shading"])
+	lights, camera, figures = BuildRenderData(scene)
+	StartPage.drawCanvas(lights, camera, figures, scene["size"]).save(path)
+	return path
+
+
+def RenderFrames(frames, output, pattern, workers):
+	os.makedirs(output, exist_ok=True)
+	jobs = [(frame, os.path.join(output, pattern % i)) for i, frame in enumerate(frames)]
+	if (workers <= 1 or len(jobs) == 1):
+		for job in jobs:
+			print(RenderFrame(job))
+		return
+
+	with concurrent.futures.ProcessPoolExecutor(max_workers=workers) as pool:
+		for path in pool.map(RenderFrame, jobs):
+			print(path)
+
+
+if __name__ == "__main__":
+	parser = argparse.ArgumentParser(description="Renders the frames of a scene file to PNG images.")
+	parser.add_argument("scene", help="JSON scene file")
+	parser.add_argument("--output", default="frames", help="output directory")
+	parser.add_argument("--pattern", default="frame_%04d.png", help="file name of the frames, given the frame number")
+	parser.add_argument("--shading", choices=["Flat", "Gouraud", "Phong"], help="overrides the shading model of the scene")
+	parser.add_argument("--size", type=int, help="overrides the canvas size of the scene")
+	parser.add_argument("--sweep", action="append", type=ParseSweep, metavar="PARAMETER=START:STOP:STEPS", help="replaces the sweeps of the scene")
+	parser.add_argument("--workers", type=int, default=os.cpu_count(), help="frames rendered in parallel")
+	args = parser.parse_args()
+
+	scene = LoadScene(args.scene)
+	if args.shading is not None:
+		scene["shading"] = args.shading
+	if args.size is not None:
+		scene["size"] = args.size
+	if args.sweep is not None:
+		scene["sweeps"] = args.sweep
+
+	RenderFrames(ExpandSweeps(scene), args.output, args.pattern, args.workers)